@@ -0,0 +1,73 @@
+# Collection of media groups (albums) for tg2obsidian_bot
+# Telegram sends every item of an album as a separate message with the same media_group_id.
+# The first message waits until no more items arrive and is handled on behalf of the whole album.
+
+import time
+import asyncio
+
+
+class Album:
+    """Messages of one media group received so far"""
+    def __init__(self, window: float):
+        self.window = window
+        self.messages = []
+        self.updated_at = time.monotonic()
+        self.updated = asyncio.Event()
+
+    def add(self, message) -> None:
+        self.messages.append(message)
+        self.updated_at = time.monotonic()
+        self.updated.set()
+
+    async def complete(self) -> list:
+        """Wait until no new item arrives for the window and return all messages ordered by message_id"""
+        while True:
+            remaining = self.updated_at + self.window - time.monotonic()
+            if remaining <= 0:
+                break
+            self.updated.clear()
+            try:
+                await asyncio.wait_for(self.updated.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+        return sorted(self.messages, key=lambda m: m.message_id)
+
+
+class AlbumCollector:
+    """Buffers messages with the same media_group_id for a short window"""
+    def __init__(self, window: float = 1.0):
+        """
+        Parameters:
+        window (float): Time (in seconds) to wait for the next item of the album after the last one received.
+        """
+        self.window = window
+        self.albums = {}
+
+    def add(self, message) -> Album | None:
+        """
+        Add the message to its album without waiting.
+        Returns the new album if the message is the first item of it, and None for other items,
+        which are handled together with the first one.
+        """
+        key = (message.chat.id, message.media_group_id)
+        album = self.albums.get(key)
+        if album is not None:
+            album.add(message)
+            return None
+
+        album = self.albums[key] = Album(self.window)
+        album.add(message)
+        return album
+
+    async def collect(self, album: Album) -> list:
+        """Wait for the rest of the album and return all its messages"""
+        try:
+            return await album.complete()
+        finally:
+            key = (album.messages[0].chat.id, album.messages[0].media_group_id)
+            if self.albums.get(key) is album:
+                del self.albums[key]
+
+    def pending(self) -> int:
+        """Number of albums being collected"""
+        return len(self.albums)
@@ -0,0 +1,96 @@
+# Audio preparation for speech recognition in tg2obsidian_bot
+# Audio is decoded once with FFMPEG, silence is found by the energy of short frames, and speech is split
+# into segments of bounded length, which are recognized in parallel by speech recognition workers.
+
+import subprocess
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+# Length of a frame (30 ms) used to measure the energy of the audio
+FRAME = SAMPLE_RATE * 30 // 1000
+# Silence added before and after speech so that the beginning and the end of words are not cut off
+PADDING = SAMPLE_RATE // 5
+# Shortest segment length (in seconds). Shorter segments would leave no room for speech between the paddings
+MIN_SEGMENT_LENGTH = 1
+
+
+def decode_audio(audio_file_path: str) -> np.ndarray:
+    """Decode any audio FFMPEG supports into 16 kHz mono 16-bit samples"""
+    command = ['ffmpeg', '-nostdin', '-threads', '0', '-i', audio_file_path,
+               '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(SAMPLE_RATE), '-']
+    result = subprocess.run(command, capture_output=True, check=False)
+    if result.returncode != 0:
+        raise RuntimeError(f'FFMPEG could not decode {audio_file_path}: {result.stderr.decode(errors="replace")[-500:]}')
+    return np.frombuffer(result.stdout, np.int16)
+
+
+def frame_energy(samples: np.ndarray) -> np.ndarray:
+    """Energy (in dB relative to the full scale) of every frame"""
+    frames = samples[:len(samples) // FRAME * FRAME].reshape(-1, FRAME).astype(np.float32) / 32768
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20 * np.log10(rms + 1e-10)
+
+
+def speech_segments(samples: np.ndarray, max_length: float = 30, min_silence: float = 0.5) -> list[tuple[int, int]]:
+    """
+    Find speech in the audio and split it into segments.
+
+    Parameters:
+    samples (np.ndarray): 16 kHz mono samples.
+    max_length (float): Maximum length of a segment in seconds, at least MIN_SEGMENT_LENGTH.
+    min_silence (float): Pauses shorter than this (in seconds) do not split speech.
+
+    Returns:
+    list: (start, end) sample positions of segments in order. Audio not longer than max_length is one segment.
+    """
+    max_samples = int(max(max_length, MIN_SEGMENT_LENGTH) * SAMPLE_RATE)
+    if len(samples) <= max_samples:
+        return [(0, len(samples))] if len(samples) else []
+
+    energy = frame_energy(samples)
+    # Threshold of speech is above the noise floor of the recording, but never above quiet speech
+    noise_floor = np.percentile(energy, 10)
+    threshold = min(max(noise_floor + 10, -55), -35)
+    speech = energy > threshold
+
+    # Close pauses shorter than min_silence
+    runs = _runs(speech)
+    min_gap = int(min_silence * SAMPLE_RATE / FRAME)
+    merged = []
+    for start, end in runs:
+        if merged and start - merged[-1][1] < min_gap:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    # Speech longer than max_length is cut at the quietest frame near the end of the allowed length
+    segments = []
+    max_frames = (max_samples - 2 * PADDING) // FRAME
+    for start, end in merged:
+        while end - start > max_frames:
+            window_start = start + max_frames * 3 // 4
+            cut = window_start + int(np.argmin(energy[window_start:start + max_frames]))
+            segments.append((start, cut))
+            start = cut
+        segments.append((start, end))
+
+    # Frames to samples with padding. Short neighbouring segments are joined while they fit into max_length
+    # to recognize them with more context
+    joined = []
+    for start, end in segments:
+        start = max(0, start * FRAME - PADDING)
+        end = min(len(samples), end * FRAME + PADDING)
+        if joined and end - joined[-1][0] <= max_samples:
+            joined[-1] = (joined[-1][0], end)
+        else:
+            if joined:
+                start = max(start, joined[-1][1])
+            joined.append((start, end))
+    return joined
+
+
+def _runs(mask: np.ndarray) -> list[tuple[int, int]]:
+    """(start, end) of runs of True values"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
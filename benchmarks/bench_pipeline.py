@@ -0,0 +1,275 @@
+# Micro-benchmarks for the message-to-note pipeline of tg2obsidian_bot
+#
+# Usage:
+#   python benchmarks/bench_pipeline.py [--output results.json] [--compare previous.json]
+#                                       [--filter parse_entities] [--repeat 5] [--html saved_page.html]
+#
+# The bot module is imported with a dummy token and temporary vault folders, so the benchmark
+# never touches the real vault, bot.log or bot_settings.db. Results are written as JSON
+# and can be compared with a previous run using --compare.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+
+def prepare_bot_module(work_path: str):
+    """Import the bot with settings safe for benchmarking"""
+    import config
+    config.token = '123456789:' + 'A' * 35
+    config.inbox_path = os.path.join(work_path, 'vault')
+    config.photo_path = os.path.join(work_path, 'vault', 'attachments')
+    config.create_link_info = False
+    config.ocr = False
+    config.recognize_voice = False
+    config.log_level = 0
+    os.makedirs(config.photo_path, exist_ok=True)
+    # database.py and logging create their files in the current folder
+    os.chdir(work_path)
+    import tg2obsidian_bot
+    return tg2obsidian_bot
+
+
+# Fixtures
+
+def make_user():
+    from aiogram.types import User
+    return User(id=123456789, is_bot=False, first_name='Ivan', last_name='Petrov', username='ivan')
+
+
+def make_message(text=None, entities=None, caption=None, caption_entities=None, **kwargs):
+    from aiogram.types import Message, Chat
+    return Message(message_id=1, date=datetime(2024, 1, 2, 10, 20, 30, tzinfo=timezone.utc),
+                   chat=Chat(id=-1009876543210, type='supergroup', title='Inbox'),
+                   from_user=make_user(), text=text, entities=entities,
+                   caption=caption, caption_entities=caption_entities, **kwargs)
+
+
+def u16_len(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+
+def long_formatted_text(paragraphs: int = 200):
+    """Long post: paragraphs with bold, italic, links, code, mentions and emoji"""
+    from aiogram.types import MessageEntity
+    pieces = []
+    entities = []
+    position = 0
+
+    def add(text, entity_type=None, **kwargs):
+        nonlocal position
+        if entity_type:
+            entities.append(MessageEntity(type=entity_type, offset=position, length=u16_len(text), **kwargs))
+        pieces.append(text)
+        position += u16_len(text)
+
+    for i in range(paragraphs):
+        add(f'Paragraph {i} ', 'bold')
+        add('starts with plain text and 😀 emoji, ')
+        add('continues in italic', 'italic')
+        add(', has a ')
+        add('link', 'text_link', url=f'https://example.com/{i}')
+        add(' and ')
+        add('inline code', 'code')
+        add(', mentions ')
+        add('@channel', 'mention')
+        add(' and ends.\n\n')
+    return ''.join(pieces), entities
+
+
+def nested_formatted_text(depth: int = 40, repeats: int = 20):
+    """Heavily nested entities: every level wraps the next one"""
+    from aiogram.types import MessageEntity
+    kinds = ['bold', 'italic', 'underline', 'strikethrough', 'spoiler']
+    block = ''.join(f'level{level} ' for level in range(depth))
+    text = ''
+    entities = []
+    for r in range(repeats):
+        start = u16_len(text)
+        offset = start
+        for level in range(depth):
+            entities.append(MessageEntity(type=kinds[level % len(kinds)], offset=offset,
+                                          length=u16_len(block) - (offset - start)))
+            offset += u16_len(f'level{level} ')
+        text += block + '\n'
+    return text, entities
+
+
+def forwarded_channel_post():
+    from aiogram.types import Chat, User
+    text, entities = long_formatted_text(20)
+    return make_message(text=text, entities=entities,
+                        forward_from_chat=Chat(id=-1001234567890, type='channel', title='News channel', username='news'),
+                        forward_from_message_id=4242,
+                        forward_from=User(id=42, is_bot=False, first_name='Anna', last_name='Smirnova', username='anna'))
+
+
+def captioned_photo():
+    from aiogram.types import PhotoSize
+    caption, caption_entities = long_formatted_text(4)
+    photo = [PhotoSize(file_id='file', file_unique_id='unique', width=1280, height=960)]
+    return make_message(caption=caption[:1024], caption_entities=[e for e in caption_entities if e.offset + e.length <= 1024],
+                        photo=photo)
+
+
+def transcript_text(sentences: int = 3000) -> str:
+    return ' '.join(f'This is the sentence number {i} of a long recognized voice message.' for i in range(sentences))
+
+
+def large_html(body_kb: int = 4096) -> str:
+    head = ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Large page</title>'
+            + '<script>var data = "' + 'x' * 50000 + '";</script>'
+            + '<meta property="og:title" content="Large page title">'
+            + '<meta property="og:description" content="Description of the large page">'
+            + '<meta property="og:image" content="https://example.com/image.png">'
+            + '<meta property="og:image:width" content="1200">'
+            + '</head>')
+    paragraph = '<p>' + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 16 + '</p>\n'
+    body = paragraph * (body_kb * 1024 // len(paragraph))
+    return head + '<body>' + body + '</body></html>'
+
+
+# Timing
+
+def measure(func, repeat: int, number: int) -> dict:
+    """Run func number times per round, repeat rounds. Returns seconds per call"""
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        rounds.append((time.perf_counter() - start) / number)
+    return {'min': min(rounds), 'median': statistics.median(rounds), 'mean': statistics.fmean(rounds),
+            'repeat': repeat, 'number': number}
+
+
+def run_async(coroutine_function):
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(coroutine_function())
+
+
+def benchmarks(bot, work_path: str, html_path: str | None) -> dict:
+    """Return benchmark name -> (function, number of calls per round)"""
+    from note_writer import NoteWriter
+    long_text, long_entities = long_formatted_text()
+    long_u16 = bot.to_u16(long_text)
+    nested_text, nested_entities = nested_formatted_text()
+    nested_u16 = bot.to_u16(nested_text)
+    long_message = make_message(text=long_text, entities=long_entities)
+    forwarded = forwarded_channel_post()
+    photo_message = captioned_photo()
+    keyword_text = transcript_text(300) + ' Нужно сделать это, печально.'
+    transcript = transcript_text()
+    if html_path:
+        with open(html_path, encoding='UTF-8', errors='replace') as f:
+            page = f.read()
+    else:
+        page = large_html()
+
+    files_path = os.path.join(work_path, 'files')
+    os.makedirs(files_path, exist_ok=True)
+    # photo.jpg and photo_1.jpg ... photo_10000.jpg exist, so unique_filename has to find photo_10001.jpg and above
+    open(os.path.join(files_path, 'photo.jpg'), 'w').close()
+    for i in range(1, 10001):
+        open(os.path.join(files_path, f'photo_{i}.jpg'), 'w').close()
+
+    note = bot.note_from_message(long_message, '')
+    note.text = long_text
+
+    async def save_messages():
+        # Fresh writer for every round, closing it writes all queued notes
+        bot.note_writer = NoteWriter()
+        for _ in range(100):
+            bot.save_message(note)
+        await bot.note_writer.close()
+
+    return {
+        'parse_entities_long': (lambda: bot.parse_entities(long_u16, long_entities, 0, len(long_u16)), 20),
+        'parse_entities_nested': (lambda: bot.parse_entities(nested_u16, nested_entities, 0, len(nested_u16)), 20),
+        'embed_formatting': (run_async(lambda: bot.embed_formatting(long_message)), 20),
+        'embed_formatting_caption': (run_async(lambda: bot.embed_formatting_caption(photo_message)), 200),
+        'get_forward_info': (lambda: bot.get_forward_info(forwarded), 10000),
+        'check_if_task': (lambda: bot.check_if_task(keyword_text), 200),
+        'check_if_negative': (lambda: bot.check_if_negative(keyword_text), 200),
+        'text_to_chunks': (lambda: bot.text_to_chunks(transcript, 4000), 10),
+        'get_open_graph_props': (lambda: bot.get_open_graph_props(page), 10),
+        'unique_filename_10k': (run_async(lambda: bot.unique_filename('photo.jpg', files_path)), 3),
+        'save_message_x100': (run_async(save_messages), 3),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ''
+
+
+def compare(results: dict, previous_path: str) -> None:
+    with open(previous_path, encoding='UTF-8') as f:
+        previous = json.load(f)['results']
+    print(f'\nComparison with {previous_path} (median, lower is better):')
+    for name, result in results.items():
+        if name in previous:
+            ratio = result['median'] / previous[name]['median']
+            print(f'{name:28} {previous[name]["median"] * 1e6:12.1f} us -> {result["median"] * 1e6:12.1f} us  x{ratio:.2f}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the message-to-note pipeline')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    parser.add_argument('--filter', default='', help='run only benchmarks containing this substring')
+    parser.add_argument('--repeat', type=int, default=5, help='number of rounds for each benchmark')
+    parser.add_argument('--html', help='saved HTML page for get_open_graph_props instead of a generated one')
+    args = parser.parse_args()
+    if args.html:
+        args.html = os.path.abspath(args.html)
+    output = os.path.abspath(args.output) if args.output else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    with tempfile.TemporaryDirectory(prefix='tg2obsidian_bench_') as work_path:
+        cwd = os.getcwd()
+        bot = prepare_bot_module(work_path)
+        results = {}
+        try:
+            for name, (func, number) in benchmarks(bot, work_path, args.html).items():
+                if args.filter not in name:
+                    continue
+                results[name] = measure(func, args.repeat, number)
+                print(f'{name:28} {results[name]["median"] * 1e6:12.1f} us per call')
+        finally:
+            from database import close_connection
+            close_connection()
+            os.chdir(cwd)
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'unit': 'seconds per call',
+        'results': results,
+    }
+    if output:
+        with open(output, 'w', encoding='UTF-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results saved to {output}')
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Per-chat ordered processing of updates for tg2obsidian_bot
+# Updates of one chat are processed strictly one after another in the order they were received,
+# updates of different chats are processed at the same time up to a global limit.
+
+import asyncio
+from collections import deque
+
+
+class ChatQueue:
+    """Jobs waiting to be processed for one chat"""
+    def __init__(self):
+        self.jobs = deque()
+        self.task = None
+
+
+class ChatScheduler:
+    """Runs jobs in order within each chat and in parallel across chats"""
+    def __init__(self, max_concurrency: int = 8):
+        """
+        Parameters:
+        max_concurrency (int): Maximum number of jobs (of different chats) running at the same time.
+        """
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.chats = {}
+
+    def submit(self, chat_id: int, job) -> asyncio.Future:
+        """
+        Queue the job for the chat. Must be called from the running event loop.
+
+        Parameters:
+        chat_id (int): Chat the job belongs to.
+        job (callable): Coroutine function without arguments, called when all previous jobs of the chat are done.
+
+        Returns:
+        asyncio.Future: Result of the job.
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            queue = self.chats[chat_id] = ChatQueue()
+            queue.task = asyncio.create_task(self._serve(chat_id, queue))
+        queue.jobs.append((job, future))
+        return future
+
+    async def run(self, chat_id: int, job):
+        """Queue the job for the chat and wait for its result"""
+        return await self.submit(chat_id, job)
+
+    def depth(self, chat_id: int) -> int:
+        """Number of jobs of the chat waiting or running"""
+        queue = self.chats.get(chat_id)
+        return len(queue.jobs) if queue else 0
+
+    def depths(self) -> dict:
+        """Chat id -> number of jobs waiting or running, for chats having any"""
+        return {chat_id: len(queue.jobs) for chat_id, queue in self.chats.items()}
+
+    async def close(self) -> None:
+        """Wait until all queued jobs are done"""
+        tasks = [queue.task for queue in self.chats.values()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _serve(self, chat_id: int, queue: ChatQueue) -> None:
+        try:
+            while queue.jobs:
+                job, future = queue.jobs[0]
+                try:
+                    if not future.cancelled():
+                        async with self.semaphore:
+                            await self._run(job, future)
+                finally:
+                    queue.jobs.popleft()
+        finally:
+            # Jobs are left only if the task itself is cancelled (the bot stops), they will never run
+            for _, future in queue.jobs:
+                future.cancel()
+            queue.jobs.clear()
+            # The queue is empty, the task stops until the next job of the chat
+            if self.chats.get(chat_id) is queue:
+                del self.chats[chat_id]
+
+    @staticmethod
+    async def _run(job, future: asyncio.Future) -> None:
+        """
+        Run the job in a task of its own and pass its result to the future.
+        A job cancelled from inside (for example, by a cancelled shared future it waits for) fails only itself,
+        the next jobs of the chat still run.
+        """
+        task = asyncio.ensure_future(job())
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            future.cancel()
+            raise
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
@@ -20,6 +20,29 @@ format_messages = True
 # Minimum time interval (in seconds) between messages to add timestamp
 message_timestamp_interval = 5
 
+# Messages of one chat are saved strictly in the order they were sent. Messages of different chats are processed
+# at the same time, so a large file in one chat does not delay notes from another chat.
+# Maximum number of messages (of different chats) processed at the same time
+max_concurrent_updates = 8
+
+# Limits of sending answers (recognized text, errors) to Telegram, in messages per second:
+# to all chats together, to one private chat and to one group. Messages over the limit wait in a queue.
+outbox_global_rate = 30
+outbox_chat_rate = 1
+outbox_group_rate = 20 / 60
+
+# The bot shows "typing..." only if a message takes longer than typing_delay seconds to process.
+typing_delay = 1.0
+# The bot reacts 👌 once to the last message of several messages saved within reaction_window seconds.
+reaction_window = 2.0
+
+# Items of an album (several photos or videos sent together) are saved as one note.
+# The bot waits this time (in seconds) for the next item of the album before saving it.
+album_window = 1.0
+
+# Maximum number of files downloaded from Telegram at the same time
+max_concurrent_downloads = 4
+
 # If True, messages will be deleted after processing.
 delete_messages = False
 
@@ -28,6 +51,23 @@ delete_messages = False
 #if False, or more than one url in the message, no callout will be created
 create_link_info = True
 
+# Link previews are cached in memory and in the bot_settings.db database, so the same page is downloaded only once.
+# Time (in seconds) to keep link previews. Default is one week.
+link_preview_ttl = 7 * 24 * 3600
+# Time (in seconds) to remember that a page could not be downloaded, so it is not requested again for every message.
+link_preview_negative_ttl = 3600
+# Number of link previews kept in memory
+link_preview_memory_size = 256
+# Maximum number of pages downloaded for link previews at the same time. They do not use connections of file downloads.
+link_preview_max_fetches = 8
+# Maximum number of pages downloaded from the same site at the same time
+link_preview_per_host = 2
+# Timeouts (in seconds) for connecting to a site and for reading the page
+link_preview_connect_timeout = 5
+link_preview_read_timeout = 10
+# Only the page head is parsed for the link preview. Reading stops at </head> or after this number of bytes.
+link_preview_max_bytes = 512 * 1024
+
 # Time zone for time stamp formatting
 time_zone = 'Europe/Moscow'
 
@@ -39,6 +79,17 @@ ocr = False
 # One or more languages to use for OCR. Defaults to 'eng'. Few languages should be delimited with +.
 ocr_languages = 'rus+eng'
 
+# Number of images recognized in parallel. Each image is processed in a separate worker process.
+ocr_workers = 2
+
+# Before recognition, images are converted to grayscale and downscaled so that the longest side does not exceed
+# ocr_max_image_size pixels and the resolution does not exceed ocr_max_dpi. Set to 0 to keep the original size.
+ocr_max_image_size = 4000
+ocr_max_dpi = 300
+
+# Maximum time (in seconds) to recognize a single image. Recognition of the image is cancelled after the timeout.
+ocr_timeout = 60
+
 # If True, voice messages will be recognized to text.
 # This requires Whisper ( https://github.com/openai/whisper ), FFMPEG, Python and PyTorch to be installed
 # on the machine where the script is running.
@@ -50,11 +101,68 @@ recognize_voice = False
 # These are general models. English-only models also exist. Check https://github.com/openai/whisper
 whisper_model = 'medium'
 
+# Speech recognition library:
+# 'whisper' - reference OpenAI Whisper on PyTorch (package openai_whisper),
+# 'faster-whisper' - the same models converted to CTranslate2 (package faster-whisper, https://github.com/SYSTRAN/faster-whisper).
+# faster-whisper is several times faster and uses less memory, especially on CPU with int8 weights.
+stt_backend = 'whisper'
+
+# Type of model weights for faster-whisper: int8 (fastest on CPU), int8_float16 or float16 (for cuda), float32
+whisper_compute_type = 'int8'
+
+# Number of CPU threads used by each speech recognition worker. 0 - let the library decide.
+whisper_cpu_threads = 0
+
 # Setting up the device for Whisper
 # By default, CPU is used. Other possible values: cuda
 whisper_device = 'cpu'
 #whisper_device = 'cuda'
 
+# Number of worker processes for speech recognition. Each worker loads its own copy of the Whisper model,
+# so increase this only if there is enough memory (RAM or GPU) for several models.
+whisper_workers = 1
+
+# Long audio is decoded once, silence is dropped and speech is split into segments of up to stt_segment_length seconds,
+# which are recognized by all workers at the same time and joined back in order. To use several CPU cores for one
+# recording, set whisper_workers to 2 or more and whisper_cpu_threads to the number of cores divided by whisper_workers.
+# Set stt_segment_length = 0 to recognize the whole file at once. Segments are at least 1 second long.
+stt_segment_length = 30
+# Pauses shorter than stt_min_silence seconds do not split speech into segments
+stt_min_silence = 0.5
+
+# The Whisper model is loaded when the first audio message arrives (this takes some time for large models)
+# and unloaded after whisper_idle_timeout seconds without audio messages to free memory. 0 - never unload.
+whisper_idle_timeout = 600
+
+# Maximum number of audio files waiting for recognition. When the queue is full, new audio is rejected with a reply.
+stt_queue_size = 10
+
+# Text recognized on images and in audio is kept in the bot_settings.db database by Telegram file id, so the same image
+# or voice message forwarded again is not recognized once more. Results of another whisper_model, stt_backend or
+# ocr_languages are never used and are removed on start. Set to False to recognize every file again.
+# Text on images already stored in photo_path can be recognized in advance with: python recognition_cache.py warm
+recognition_cache = True
+# Time (in seconds) to keep results not used since then. Default is half a year.
+recognition_cache_max_age = 180 * 24 * 3600
+# Total size (in bytes) of cached text. The least recently used results are removed first.
+recognition_cache_max_size = 50 * 1024 * 1024
+
+# New messages are not written to the note immediately but collected and appended in batches.
+# A message is written at most note_flush_interval seconds after it is received,
+# or at once when note_flush_size characters are waiting to be written to the same note.
+note_flush_interval = 1.0
+note_flush_size = 65536
+
+# 'never' - leave writing the note to disk to the operating system (default),
+# 'batch' - force writing to disk (fsync) after each batch. Slower, but safer on network or synced drives.
+note_fsync = 'never'
+
+# If a note cannot be written (for example, the folder is not available), writing is retried note_write_retries times,
+# note_flush_interval seconds apart. Then the sender gets an error reply, and the text is appended to note_spool_path
+# in the script folder, so it can be copied to the note by hand.
+note_write_retries = 3
+note_spool_path = 'unsaved_notes.md'
+
 # Note filename template. Available variables: {year}, {month}, {day}
 # With the default template, the resulting filename will have the format Telegram-2023-01-02.md
 note_name_template = 'Telegram-{year}-{month}-{day}'
@@ -83,3 +191,58 @@ negative_keywords = {'негатив', 'печал'}
 # Tag to add to the text where a keyword is detected
 negative_tag = '#негатив'
 
+# More tags to add to the message when one of the keywords is found in the message text (case insensitive).
+# Each tag is followed by the set of its keywords. Any number of tags and keywords can be specified,
+# the text of the message is scanned only once.
+# To turn this off, specify keyword_tags = {}
+keyword_tags = {}
+# keyword_tags = {'#work': {'проект', 'встреча'}, '#health': {'врач', 'doctor'}}
+
+
+# The bot checks this file for changes every config_reload_interval seconds and applies new settings without restart.
+# Settings of notes (paths, templates, keywords, formatting, time zone, allowed chats) are applied immediately.
+# The token and settings of OCR, speech recognition and downloads take effect only after restart.
+# Set to 0 to turn off reloading.
+config_reload_interval = 5
+
+# How the bot receives updates from Telegram:
+# 'polling' - the bot asks Telegram for new messages (default, works on any computer),
+# 'webhook' - Telegram sends new messages to the bot's web server. This requires a public HTTPS address,
+# usually a reverse proxy (nginx, Caddy, etc.) that terminates TLS and forwards requests to webhook_host:webhook_port.
+update_mode = 'polling'
+
+# Public HTTPS address Telegram sends updates to. It must end with webhook_path.
+webhook_url = 'https://example.com/tg2obsidian'
+# Address and port the bot's web server listens on, and the path of the webhook
+webhook_host = '127.0.0.1'
+webhook_port = 8080
+webhook_path = '/tg2obsidian'
+# Secret token Telegram sends with every update. Requests without it are rejected. Leave empty to turn off the check.
+webhook_secret = ''
+# Certificate and private key to serve HTTPS without a reverse proxy. A self-signed certificate is uploaded to Telegram.
+# Leave empty when TLS is terminated by a proxy.
+webhook_ssl_cert = ''
+webhook_ssl_key = ''
+
+# Address of a local Bot API server (for example, 'http://127.0.0.1:8081') to use instead of api.telegram.org.
+# Also useful for testing with a fake Telegram endpoint. Leave empty to use Telegram servers.
+telegram_api_server = ''
+
+# Processing time of updates and handlers, downloads, speech recognition, OCR, note writes and queue lengths are measured
+# and shown by the /stats command. Set metrics_port to serve them in Prometheus format on http://metrics_host:metrics_port/metrics.
+# 0 - do not serve metrics. Keep metrics_host local unless the port is protected by a firewall.
+metrics_host = '127.0.0.1'
+metrics_port = 0
+
+# Profiling of updates, to find out where the time goes when the bot is slow. Profiles are written to profile_path
+# and summarized with: python profiler.py [--top 30] [--handler handle_photo]
+# Part of updates profiled from start to end, for example 0.01 for one update of a hundred. 0 - none.
+profile_sample_rate = 0
+# Updates processed longer than profile_slow_threshold seconds are profiled from that moment to the end,
+# and the place where the update was waiting at that moment is recorded. 0 - do not trace slow updates.
+profile_slow_threshold = 0
+# Also record memory allocations (tracemalloc) of profiled updates. This slows the bot down while an update is profiled.
+profile_memory = False
+profile_path = 'profiles'
+# Number of profiles kept, older ones are removed
+profile_max_files = 100
@@ -1,19 +1,65 @@
+import json
+import asyncio
 import logging
 import sqlite3
 from sqlite3 import Error
 
-from config import inbox_path
-
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO, filename = 'bot.log', encoding = 'UTF-8', datefmt = '%Y-%m-%d %H:%M:%S')
 
+# One connection is kept open for the whole bot session
+_connection = None
+
+# Writes made for every message are committed together at most once per this time (in seconds)
+COMMIT_DELAY = 1.0
+_commit_handle = None
+
+# Settings of all chats are loaded once and kept in memory: chat_id -> {setting name: value}
+_chat_settings = {}
+
 def create_connection():
-    """Create a database connection to the SQLite database"""
+    """Return the persistent connection to the SQLite database, opening it on first use"""
+    global _connection
+    if _connection is None:
+        try:
+            conn = sqlite3.connect('bot_settings.db')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            _connection = conn
+        except Error as e:
+            logging.error(f"Error connecting to database: {e}")
+            return None
+    return _connection
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        commit_pending()
+        _connection.close()
+        _connection = None
+
+def commit_pending():
+    """Commit writes postponed by _commit_later"""
+    global _commit_handle
+    if _commit_handle is not None:
+        _commit_handle.cancel()
+        _commit_handle = None
+    if _connection is not None:
+        try:
+            _connection.commit()
+        except Error as e:
+            logging.error(f"Database error: {e}")
+
+def _commit_later(conn):
+    """Commit soon, together with other writes, so a message does not wait for its own commit"""
+    global _commit_handle
     try:
-        conn = sqlite3.connect('bot_settings.db')
-        return conn
-    except Error as e:
-        logging.error(f"Error connecting to database: {e}")
-        return None
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Not in the bot, nothing else will commit
+        conn.commit()
+        return
+    if _commit_handle is None:
+        _commit_handle = loop.call_later(COMMIT_DELAY, commit_pending)
 
 def init_database():
     """Create the settings table if it doesn't exist"""
@@ -26,11 +72,53 @@ def init_database():
                 (chat_id INTEGER PRIMARY KEY,
                  notes_folder TEXT NOT NULL)
             ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS attachments
+                (file_unique_id TEXT PRIMARY KEY,
+                 sha256 TEXT NOT NULL,
+                 file_name TEXT NOT NULL)
+            ''')
+            c.execute('CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256)')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS link_previews
+                (url TEXT PRIMARY KEY,
+                 props TEXT,
+                 fetched_at REAL NOT NULL)
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS recognition_results
+                (file_key TEXT NOT NULL,
+                 engine TEXT NOT NULL,
+                 model TEXT NOT NULL,
+                 language TEXT NOT NULL,
+                 text TEXT NOT NULL,
+                 size INTEGER NOT NULL,
+                 used_at REAL NOT NULL,
+                 PRIMARY KEY (file_key, engine, model, language))
+            ''')
+            c.execute('CREATE INDEX IF NOT EXISTS recognition_results_used_at ON recognition_results (used_at)')
             conn.commit()
         except Error as e:
             logging.error(f"Error creating table: {e}")
-        finally:
-            conn.close()
+
+def load_chat_settings():
+    """Read settings of all chats into memory"""
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('SELECT * FROM chat_settings')
+            columns = [column[0] for column in c.description]
+            _chat_settings.clear()
+            for row in c.fetchall():
+                settings = dict(zip(columns, row))
+                _chat_settings[settings.pop('chat_id')] = settings
+        except Error as e:
+            logging.error(f"Database error: {e}")
+
+def get_chat_settings(chat_id) -> dict:
+    """Return all settings of the chat. Settings are read from memory, not from the database"""
+    return _chat_settings.get(chat_id, {})
 
 def set_notes_folder(chat_id, folder_path) -> str:
     # Save to database
@@ -39,34 +127,218 @@ def set_notes_folder(chat_id, folder_path) -> str:
         try:
             c = conn.cursor()
             c.execute('''
-                INSERT OR REPLACE INTO chat_settings (chat_id, notes_folder)
+                INSERT INTO chat_settings (chat_id, notes_folder)
                 VALUES (?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET notes_folder = excluded.notes_folder
             ''', (chat_id, folder_path))
             conn.commit()
+            # Write-through: keep the in-memory copy in sync with the database
+            _chat_settings.setdefault(chat_id, {})['notes_folder'] = folder_path
             result = f"Notes folder for {chat_id} set to: {folder_path}"
             logging.info(result)
         except Error as e:
             result = f"Error saving settings for for {chat_id}: {e}"
             logging.error(result)
         finally:
-            conn.close()
             return result
 
 def get_notes_folder(chat_id) -> str:
+    return get_chat_settings(chat_id).get('notes_folder', "")
+
+def find_attachment(file_unique_id) -> str:
+    """Return name of the stored file with the given Telegram file_unique_id, or empty string"""
     conn = create_connection()
-    folder_path = ""
+    file_name = ""
     if conn is not None:
         try:
             c = conn.cursor()
-            c.execute('SELECT notes_folder FROM chat_settings WHERE chat_id = ?', 
-                    (chat_id,))
+            c.execute('SELECT file_name FROM attachments WHERE file_unique_id = ?',
+                    (file_unique_id,))
             row = c.fetchone()
             if row:
-                folder_path = row[0]
+                file_name = row[0]
         except Error as e:
             logging.error(f"Database error: {e}")
-        finally:
-            conn.close()
-    return folder_path
+    return file_name
+
+def find_attachments_by_hash(sha256) -> list:
+    """Return names of the stored files with the given SHA-256 hash, oldest first"""
+    conn = create_connection()
+    file_names = []
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('SELECT file_name FROM attachments WHERE sha256 = ? ORDER BY rowid',
+                    (sha256,))
+            file_names = [row[0] for row in c.fetchall()]
+        except Error as e:
+            logging.error(f"Database error: {e}")
+    return file_names
+
+def save_attachment(file_unique_id, sha256, file_name) -> None:
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('''
+                INSERT OR REPLACE INTO attachments (file_unique_id, sha256, file_name)
+                VALUES (?, ?, ?)
+            ''', (file_unique_id, sha256, file_name))
+            _commit_later(conn)
+        except Error as e:
+            logging.error(f"Error saving attachment {file_name}: {e}")
+
+def get_link_preview(url) -> tuple | None:
+    """Return (props, fetched_at) of the cached link preview, or None. props is None for cached failures"""
+    conn = create_connection()
+    result = None
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('SELECT props, fetched_at FROM link_previews WHERE url = ?',
+                    (url,))
+            row = c.fetchone()
+            if row:
+                result = (json.loads(row[0]) if row[0] is not None else None, row[1])
+        except Error as e:
+            logging.error(f"Database error: {e}")
+    return result
+
+def save_link_preview(url, props, fetched_at) -> None:
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('''
+                INSERT OR REPLACE INTO link_previews (url, props, fetched_at)
+                VALUES (?, ?, ?)
+            ''', (url, json.dumps(props, ensure_ascii=False) if props is not None else None, fetched_at))
+            _commit_later(conn)
+        except Error as e:
+            logging.error(f"Error saving link preview for {url}: {e}")
+
+def delete_link_previews(fetched_before) -> None:
+    """Remove link previews fetched before the given timestamp"""
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM link_previews WHERE fetched_at < ?', (fetched_before,))
+            conn.commit()
+        except Error as e:
+            logging.error(f"Database error: {e}")
+
+def list_attachments() -> list:
+    """Return (file_unique_id, file_name) of all stored files, oldest first"""
+    conn = create_connection()
+    attachments = []
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('SELECT file_unique_id, file_name FROM attachments ORDER BY rowid')
+            attachments = c.fetchall()
+        except Error as e:
+            logging.error(f"Database error: {e}")
+    return attachments
+
+def get_recognition_result(file_key, engine, model, language, used_at) -> str | None:
+    """Return the cached recognized text and mark it as used at the given timestamp, or None"""
+    conn = create_connection()
+    text = None
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            key = (file_key, engine, model, language)
+            c.execute('''
+                SELECT text FROM recognition_results
+                WHERE file_key = ? AND engine = ? AND model = ? AND language = ?
+            ''', key)
+            row = c.fetchone()
+            if row:
+                text = row[0]
+                c.execute('''
+                    UPDATE recognition_results SET used_at = ?
+                    WHERE file_key = ? AND engine = ? AND model = ? AND language = ?
+                ''', (used_at, *key))
+                _commit_later(conn)
+        except Error as e:
+            logging.error(f"Database error: {e}")
+    return text
+
+def save_recognition_result(file_key, engine, model, language, text, used_at) -> None:
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('''
+                INSERT OR REPLACE INTO recognition_results (file_key, engine, model, language, text, size, used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (file_key, engine, model, language, text, len(text.encode()), used_at))
+            _commit_later(conn)
+        except Error as e:
+            logging.error(f"Error saving recognition result for {file_key}: {e}")
+
+def get_recognition_results_size() -> tuple:
+    """Return the number of cached recognition results and their total size in bytes"""
+    conn = create_connection()
+    result = (0, 0)
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM recognition_results')
+            result = c.fetchone()
+        except Error as e:
+            logging.error(f"Database error: {e}")
+    return result
+
+def delete_recognition_results(used_before, max_size) -> None:
+    """Remove recognition results not used since the given timestamp, then the least recently used ones above max_size bytes"""
+    conn = create_connection()
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM recognition_results WHERE used_at < ?', (used_before,))
+            c.execute('''
+                DELETE FROM recognition_results WHERE rowid IN
+                (SELECT rowid FROM
+                    (SELECT rowid, SUM(size) OVER (ORDER BY used_at DESC, rowid DESC) AS total FROM recognition_results)
+                 WHERE total > ?)
+            ''', (max_size,))
+            conn.commit()
+        except Error as e:
+            logging.error(f"Database error: {e}")
+
+def delete_stale_recognition_results(engine, model, language) -> int:
+    """Remove results of the engine made with another model or language. Returns the number of removed results"""
+    conn = create_connection()
+    deleted = 0
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM recognition_results WHERE engine = ? AND (model != ? OR language != ?)',
+                    (engine, model, language))
+            deleted = c.rowcount
+            conn.commit()
+        except Error as e:
+            logging.error(f"Database error: {e}")
+    return deleted
+
+def clear_recognition_results(engine='') -> int:
+    """Remove all recognition results of the engine, or of all engines. Returns the number of removed results"""
+    conn = create_connection()
+    deleted = 0
+    if conn is not None:
+        try:
+            c = conn.cursor()
+            if engine:
+                c.execute('DELETE FROM recognition_results WHERE engine = ?', (engine,))
+            else:
+                c.execute('DELETE FROM recognition_results')
+            deleted = c.rowcount
+            conn.commit()
+        except Error as e:
+            logging.error(f"Database error: {e}")
+    return deleted
 
-init_database()
\ No newline at end of file
+init_database()
+load_chat_settings()
\ No newline at end of file
@@ -0,0 +1,58 @@
+# File downloads for tg2obsidian_bot
+# All downloads share one pooled HTTP session and are streamed to disk in chunks
+
+import os
+import asyncio
+import hashlib
+import aiohttp
+import aiofiles
+
+CHUNK_SIZE = 256 * 1024
+
+
+class Downloader:
+    """Long-lived HTTP session with a bounded number of downloads in flight"""
+    def __init__(self, max_downloads: int = 4, chunk_size: int = CHUNK_SIZE):
+        self.max_downloads = max(1, max_downloads)
+        self.chunk_size = chunk_size
+        self.semaphore = asyncio.Semaphore(self.max_downloads)
+        self._session = None
+
+    def session(self) -> aiohttp.ClientSession:
+        """Return shared session, creating it on first use. Connections are kept alive between requests"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_downloads * 2, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def download(self, url: str, destination: str) -> str:
+        """
+        Streams url content into a temporary file next to destination and renames it into place.
+        SHA-256 of the content is computed while the file streams in.
+
+        Returns:
+        str: SHA-256 hex digest of the saved file, or empty string if the download failed.
+        """
+        temp_destination = f'{destination}.part'
+        sha256 = hashlib.sha256()
+        async with self.semaphore:
+            async with self.session().get(url) as resp:
+                if resp.status != 200:
+                    return ''
+                try:
+                    async with aiofiles.open(temp_destination, mode='wb') as f:
+                        async for chunk in resp.content.iter_chunked(self.chunk_size):
+                            sha256.update(chunk)
+                            await f.write(chunk)
+                    os.replace(temp_destination, destination)
+                except BaseException:
+                    if os.path.exists(temp_destination):
+                        os.remove(temp_destination)
+                    raise
+        return sha256.hexdigest()
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
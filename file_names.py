@@ -0,0 +1,84 @@
+# Allocation of unique file names for attachments of tg2obsidian_bot
+# Each folder is scanned once, then the highest numeric index of every name stem is kept in memory,
+# so a new name costs one file creation instead of probing all existing names one by one.
+
+import os
+import re
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Name without extension split into the stem and the numeric index at its end
+INDEXED_NAME = re.compile(r'(.*?)(\d+)$', re.DOTALL)
+
+
+class FileNameAllocator:
+    """Reserves unique file names in folders by creating empty files with O_EXCL"""
+    def __init__(self):
+        # folder -> {(stem, extension): highest index used}
+        self.folders = {}
+        self.lock = threading.Lock()
+        # Names are reserved one by one in the order requested, so items of an album get indexes in their order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file_names')
+
+    def unique_filename(self, file: str, path: str) -> str:
+        """Reserve the file name if it is free, otherwise the name with the next free _N suffix"""
+        counters = self._counters(path)
+        if self._create(path, file):
+            self._record(counters, file)
+            return file
+        filename, filext = os.path.splitext(file)
+        return self._next(counters, path, f'{filename}_', filext, lambda i: f'{filename}_{i}{filext}')
+
+    def unique_indexed_filename(self, file: str, path: str) -> str:
+        """Reserve the file name with the next free two-digit (or longer) index added to it"""
+        counters = self._counters(path)
+        filename, filext = os.path.splitext(file)
+        return self._next(counters, path, filename, filext, lambda i: f'{filename}{i:02}{filext}')
+
+    async def allocate(self, file: str, path: str, indexed: bool = False) -> str:
+        """Reserve a unique name off the event loop"""
+        reserve = self.unique_indexed_filename if indexed else self.unique_filename
+        return await asyncio.get_running_loop().run_in_executor(self.executor, reserve, file, path)
+
+    def _next(self, counters: dict, path: str, stem: str, filext: str, make_name) -> str:
+        while True:
+            with self.lock:
+                index = counters.get((stem, filext), 0) + 1
+                counters[(stem, filext)] = index
+            file = make_name(index)
+            # The file may be created by somebody else since the folder was scanned
+            if self._create(path, file):
+                return file
+
+    def _counters(self, path: str) -> dict:
+        counters = self.folders.get(path)
+        if counters is not None:
+            return counters
+        os.makedirs(path, exist_ok=True)
+        counters = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                self._record(counters, entry.name)
+        with self.lock:
+            return self.folders.setdefault(path, counters)
+
+    def _record(self, counters: dict, file: str) -> None:
+        filename, filext = os.path.splitext(file)
+        match = INDEXED_NAME.match(filename)
+        if match:
+            key = (match[1], filext)
+            index = int(match[2])
+            with self.lock:
+                if counters.get(key, 0) < index:
+                    counters[key] = index
+
+    @staticmethod
+    def _create(path: str, file: str) -> bool:
+        """Create an empty file to reserve the name. Returns False if the file already exists"""
+        try:
+            fd = os.open(os.path.join(path, file), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
@@ -0,0 +1,334 @@
+# Import of Telegram Desktop chat exports into daily notes of tg2obsidian_bot
+#
+# Usage:
+#   python import_history.py path/to/result.json [--folder Inbox/Chat] [--link] [--jobs 8]
+#                            [--since 2021-01-01] [--until 2023-12-31]
+#
+# Export the chat in Telegram Desktop (Export chat history) in JSON format. The export is read
+# as a stream, so memory use does not depend on its size. Messages are formatted the same way as
+# messages received by the bot and appended to daily notes, media files are copied into photo_path.
+# Only exports of a single chat are supported, not the full account export.
+
+import os
+import sys
+import json
+import time
+import codecs
+import shutil
+import asyncio
+import argparse
+from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.types import MessageEntity
+
+import config
+import settings
+import tg2obsidian_bot as bot_module
+from database import get_notes_folder, close_connection
+
+# Entity types of the export named differently from Bot API entity types
+ENTITY_TYPES = {
+    'link': 'url',
+    'phone': 'phone_number',
+    'mention_name': 'text_mention',
+}
+
+# Media types embedded into the note, other files are linked
+EMBEDDED_MEDIA = ('animation', 'video_file', 'video_message', 'voice_message', 'audio_file', 'sticker')
+
+# Media not included into the export is marked with a text like this instead of a path
+FILE_NOT_INCLUDED = '(File not included'
+
+
+class ExportReader:
+    """Reads messages from a Telegram Desktop JSON export one by one without loading the whole file"""
+    def __init__(self, path: str, chunk_size: int = 1024 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.bytes_read = 0
+        self.chat = {}
+        self._file = None
+        self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def messages(self):
+        """Yield messages of the export as dicts. Top level values before messages are put into chat"""
+        with open(self.path, 'rb') as self._file:
+            self._expect('{')
+            while True:
+                if self._next_char() == '}':
+                    return
+                key = self._value()
+                self._expect(':')
+                if key == 'messages':
+                    yield from self._array()
+                else:
+                    self.chat[key] = self._value()
+                if self._next_char() == ',':
+                    self._pos += 1
+
+    def _array(self):
+        self._expect('[')
+        if self._next_char() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            char = self._next_char()
+            self._pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f'Unexpected {char!r} in the list of messages at byte {self.bytes_read}')
+
+    def _value(self):
+        """Decode one JSON value, reading more of the file while the value is incomplete"""
+        self._next_char()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._read()
+
+    def _next_char(self) -> str:
+        """Skip whitespace and return the next character without consuming it"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._eof:
+                raise ValueError(f'Unexpected end of {self.path}')
+            self._read()
+
+    def _expect(self, char: str) -> None:
+        found = self._next_char()
+        if found != char:
+            raise ValueError(f'Expected {char!r} but found {found!r} at byte {self.bytes_read} of {self.path}')
+        self._pos += 1
+
+    def _read(self) -> None:
+        data = self._file.read(self.chunk_size)
+        self.bytes_read += len(data)
+        self._eof = not data
+        # Drop the consumed part of the buffer so it holds no more than the current message and one chunk
+        self._buffer = self._buffer[self._pos:] + self._decoder.decode(data, final=self._eof)
+        self._pos = 0
+
+
+def export_text(message: dict) -> tuple[str, list[MessageEntity]]:
+    """Make up message text and Bot API entities from text_entities of the exported message"""
+    pieces = []
+    entities = []
+    offset = 0
+    for part in message.get('text_entities', []):
+        text = part.get('text', '')
+        length = len(text.encode('utf-16-le')) // 2
+        entity_type = part.get('type', 'plain')
+        if entity_type != 'plain' and length:
+            # Exported entities are well-formed, so pydantic validation is skipped
+            entities.append(MessageEntity.model_construct(type=ENTITY_TYPES.get(entity_type, entity_type), offset=offset, length=length,
+                                                          url=part.get('href'), language=part.get('language')))
+        pieces.append(text)
+        offset += length
+    return ''.join(pieces), entities
+
+
+def format_text(text: str, entities: list[MessageEntity]) -> str:
+    """Convert exported text to Markdown the same way as text of received messages"""
+    if not bot_module.format_messages() or not entities:
+        return text
+    try:
+        text_u16 = bot_module.to_u16(text)
+        return bot_module.parse_entities(text_u16, entities, 0, len(text_u16))
+    except Exception:
+        return text
+
+
+class HistoryImporter:
+    """Converts exported messages into note blocks and copies exported media files"""
+    def __init__(self, export_path: str, notes_folder: str, link: bool = False, jobs: int = 4,
+                 since: str = '', until: str = ''):
+        self.export_folder = os.path.dirname(os.path.abspath(export_path))
+        self.folder_path = os.path.join(settings.current().inbox_path, notes_folder)
+        os.makedirs(self.folder_path, exist_ok=True)
+        self.link = link
+        self.since = since
+        self.until = until
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.copies = asyncio.Semaphore(jobs * 4)
+        self.copy_tasks = set()
+        self.last_message_time = None
+        self.imported = 0
+        self.skipped = 0
+        self.files = 0
+        self.missing_files = 0
+
+    async def add(self, message: dict) -> None:
+        """Append the exported message to its daily note"""
+        if message.get('type') != 'message':
+            self.skipped += 1
+            return
+
+        if 'date_unixtime' in message:
+            message_date = dt.fromtimestamp(int(message['date_unixtime']), settings.current().time_zone)
+        else:
+            message_date = settings.current().time_zone.localize(dt.fromisoformat(message['date']))
+        curr_date = message_date.strftime('%Y-%m-%d')
+        if (self.since and curr_date < self.since) or (self.until and curr_date > self.until):
+            self.skipped += 1
+            return
+
+        text, entities = export_text(message)
+        note_text = format_text(text, entities)
+        attachment = await self.attachment(message)
+        if attachment:
+            note_text = f'{attachment}\n{note_text}'
+        if not note_text.strip():
+            self.skipped += 1
+            return
+        if message.get('forwarded_from'):
+            note_text = bot_module.bold(f'Forwarded message by {message["forwarded_from"]}') + '\n' + note_text
+
+        # Messages sent close to each other are grouped under one time stamp, as the bot does
+        add_timestamp = (self.last_message_time is None
+                         or (message_date - self.last_message_time).total_seconds() >= settings.current().message_timestamp_interval)
+        self.last_message_time = message_date
+
+        note_block = bot_module.format_note_block(note_text, curr_date, message_date.strftime('%H:%M:%S'), add_timestamp)
+        bot_module.note_writer.append(bot_module.get_note_name(curr_date, self.folder_path), note_block)
+        self.imported += 1
+
+    async def attachment(self, message: dict) -> str:
+        """Start copying the exported media file and return the link to embed into the note"""
+        source = message.get('photo') or message.get('file')
+        if not source:
+            return ''
+        if source.startswith(FILE_NOT_INCLUDED):
+            self.missing_files += 1
+            return ''
+        source_path = os.path.join(self.export_folder, source)
+        if not os.path.exists(source_path):
+            self.missing_files += 1
+            return ''
+
+        file_name = await bot_module.unique_filename(os.path.basename(source), config.photo_path)
+        await self.copies.acquire()
+        task = asyncio.get_running_loop().run_in_executor(self.executor, self.copy_file, source_path,
+                                                          os.path.join(config.photo_path, file_name))
+        task.add_done_callback(self.copy_done)
+        self.copy_tasks.add(task)
+
+        if 'photo' in message or message.get('media_type') in EMBEDDED_MEDIA:
+            return f'![[{file_name}]]'
+        return f'[[{file_name}]]'
+
+    def copy_file(self, source: str, destination: str) -> None:
+        # The destination is an empty file reserving the name, it is replaced
+        if self.link:
+            link_path = destination + '.part'
+            try:
+                os.link(source, link_path)
+                os.replace(link_path, destination)
+                return
+            except OSError:
+                # Different file systems or no hard link support, fall back to copying
+                pass
+        shutil.copy2(source, destination)
+
+    def copy_done(self, task) -> None:
+        self.copy_tasks.discard(task)
+        self.copies.release()
+        if task.cancelled():
+            return
+        if task.exception():
+            print(f'\nError copying file: {task.exception()}')
+        else:
+            self.files += 1
+
+    async def close(self) -> None:
+        """Wait for all copies and note writes to complete"""
+        if self.copy_tasks:
+            await asyncio.gather(*self.copy_tasks, return_exceptions=True)
+        self.executor.shutdown()
+        await bot_module.note_writer.close()
+
+
+def print_progress(reader: ExportReader, importer: HistoryImporter, started: float, final: bool = False) -> None:
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    percent = 100 * reader.bytes_read / reader.size if reader.size else 100
+    print(f'\r{percent:5.1f}% {reader.bytes_read / 2**20:,.1f} MB, {importer.imported:,} messages '
+          f'({importer.imported / elapsed:,.0f} msg/s, {reader.bytes_read / 2**20 / elapsed:,.1f} MB/s), '
+          f'{importer.files:,} files', end='\n' if final else '', flush=True)
+
+
+async def import_export(export_path: str, notes_folder: str | None = None, link: bool = False, jobs: int = 4,
+                        since: str = '', until: str = '', max_pending: int = 10000) -> HistoryImporter:
+    """Import all messages of the export. If notes_folder is None, the folder set for the chat by /setfolder is used"""
+    reader = ExportReader(export_path)
+    messages = reader.messages()
+    first_message = next(messages, None)
+
+    if notes_folder is None:
+        # Bot API ids of supergroups and channels are the exported ids with -100 prefix
+        chat_id = reader.chat.get('id', 0)
+        if 'supergroup' in reader.chat.get('type', '') or 'channel' in reader.chat.get('type', ''):
+            chat_id = int(f'-100{chat_id}')
+        notes_folder = get_notes_folder(chat_id)
+
+    importer = HistoryImporter(export_path, notes_folder, link, jobs, since, until)
+    print(f'Importing {reader.chat.get("name", export_path)} into {importer.folder_path}')
+    started = time.perf_counter()
+    last_progress = started
+    try:
+        if first_message is not None:
+            await importer.add(first_message)
+        for count, message in enumerate(messages, start=1):
+            await importer.add(message)
+            if count % 256 == 0:
+                # Let note writer and copy tasks run, and wait if they fall behind
+                await asyncio.sleep(0)
+                while bot_module.note_writer.depth() > max_pending:
+                    await asyncio.sleep(0.01)
+            if time.perf_counter() - last_progress >= 1:
+                last_progress = time.perf_counter()
+                print_progress(reader, importer, started)
+    finally:
+        await importer.close()
+    print_progress(reader, importer, started, final=True)
+    print(f'Skipped {importer.skipped:,} service or empty messages, {importer.missing_files:,} files not included into the export')
+    return importer
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Import Telegram Desktop chat export (result.json) into daily notes')
+    parser.add_argument('export', help='result.json of the chat export')
+    parser.add_argument('--folder', help='notes folder relative to inbox_path (default: folder set for the chat by /setfolder)')
+    parser.add_argument('--link', action='store_true', help='hard link media files instead of copying them')
+    parser.add_argument('--jobs', type=int, default=4, help='number of media files copied in parallel')
+    parser.add_argument('--since', default='', help='import messages from this date (YYYY-MM-DD)')
+    parser.add_argument('--until', default='', help='import messages up to this date inclusive (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(import_export(args.export, args.folder, args.link, max(1, args.jobs), args.since, args.until))
+    except (OSError, ValueError) as e:
+        print(f'\nImport failed: {e}', file=sys.stderr)
+        sys.exit(1)
+    finally:
+        close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Keyword rules for tg2obsidian_bot
+# All task and tag keywords are compiled into one Aho-Corasick automaton,
+# so a note is scanned once regardless of the number of keywords
+
+# Up to this number of keywords, built-in substring search is faster than the automaton written in Python
+SUBSTRING_SEARCH_LIMIT = 200
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton reporting which keyword groups occur in a text"""
+    def __init__(self, keywords: dict[str, set[int]]):
+        """
+        Parameters:
+        keywords (dict): Casefolded keyword -> ids of the groups (rules) the keyword belongs to.
+        """
+        self.keywords = [(keyword, frozenset(ids)) for keyword, ids in keywords.items() if keyword]
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [frozenset()]
+        outputs = [set()]
+        for keyword, ids in keywords.items():
+            if not keyword:
+                continue
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    outputs.append(set())
+                state = next_state
+            outputs[state] |= ids
+
+        # Breadth-first pass sets failure links and merges outputs of the suffixes
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                outputs[next_state] |= outputs[self.fail[next_state]]
+                queue.append(next_state)
+        self.output = [frozenset(ids) for ids in outputs]
+        self.all_ids = frozenset().union(*self.output)
+
+    def find(self, text: str) -> set[int]:
+        """Return ids of all groups having at least one keyword in the casefolded text"""
+        if len(self.keywords) <= SUBSTRING_SEARCH_LIMIT:
+            found = set()
+            for keyword, ids in self.keywords:
+                if not ids <= found and keyword in text:
+                    found |= ids
+            return found
+
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+                if len(found) == len(self.all_ids):
+                    break
+        return found
+
+
+class KeywordRules:
+    """Turns notes with task keywords into tasks and adds tags to notes with tag keywords"""
+    TASK = 0
+
+    def __init__(self, task_keywords=(), tag_keywords: dict | None = None):
+        """
+        Parameters:
+        task_keywords (iterable): Keywords converting the note into a task.
+        tag_keywords (dict): Tag -> keywords adding the tag to the note. Tags are added in this order.
+        """
+        self.tags = list((tag_keywords or {}).keys())
+        keywords = {}
+        for keyword in task_keywords:
+            keywords.setdefault(keyword.casefold(), set()).add(self.TASK)
+        for index, tag in enumerate(self.tags, start=1):
+            for keyword in tag_keywords[tag]:
+                keywords.setdefault(keyword.casefold(), set()).add(index)
+        self.matcher = KeywordMatcher(keywords)
+
+    def match(self, note_body: str) -> tuple[bool, list[str]]:
+        """Return whether the note is a task and the list of tags to add"""
+        found = self.matcher.find(note_body.casefold())
+        tags = [tag for index, tag in enumerate(self.tags, start=1) if index in found]
+        return self.TASK in found, tags
+
+    def apply(self, note_body: str) -> str:
+        """Add tags on separate lines after the note and make up a task if needed"""
+        is_task, tags = self.match(note_body)
+        for tag in tags:
+            note_body += f'\n{tag}'
+        if is_task:
+            note_body = '- [ ] ' + note_body
+        return note_body
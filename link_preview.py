@@ -0,0 +1,237 @@
+# Link preview cache for tg2obsidian_bot
+# OpenGraph properties of web pages are kept in memory and in bot_settings.db,
+# so a link shared again is not downloaded and parsed once more.
+# Pages are fetched with a session of their own, so slow sites do not take connections from file downloads.
+
+import re
+import time
+import codecs
+import asyncio
+import logging
+import aiohttp
+from collections import OrderedDict
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+from database import get_link_preview, save_link_preview, delete_link_previews
+
+# Pages are parsed in pieces of this size, parsing stops at </head>
+PARSE_CHUNK_SIZE = 16 * 1024
+
+_meta_charset = re.compile(rb'''<meta[^>]+charset\s*=\s*["']?\s*([a-zA-Z0-9_\-:.]+)''', re.IGNORECASE)
+
+
+class OpenGraphParser(HTMLParser):
+    """Incremental parser collecting og:* properties, description and title from the page head"""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.og_props = {}
+        self.description = None
+        self.title = None
+        self.title_parts = None
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            content = attrs.get('content')
+            if content is None:
+                return
+            prop = attrs.get('property')
+            if prop and prop.startswith('og:'):
+                self.og_props[prop[3:].lstrip()] = content
+            elif attrs.get('name') == 'description' and self.description is None:
+                self.description = content
+        elif tag == 'title' and self.title is None:
+            self.title_parts = []
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.title_parts is not None:
+            self.title = ''.join(self.title_parts).strip()
+            self.title_parts = None
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.title_parts is not None:
+            self.title_parts.append(data)
+
+    def props(self) -> dict:
+        props = dict(self.og_props)
+        if not 'description' in props and self.description is not None:
+            props['description'] = self.description
+        if not 'title' in props and self.title is not None:
+            props['title'] = self.title
+        return props
+
+
+def get_open_graph_props(page: str) -> dict:
+    """Return OpenGraph properties (plus description and title) found in the head of the page"""
+    parser = OpenGraphParser()
+    for start in range(0, len(page), PARSE_CHUNK_SIZE):
+        parser.feed(page[start:start + PARSE_CHUNK_SIZE])
+        if parser.done:
+            break
+    return parser.props()
+
+
+def detect_charset(head: bytes, header_charset: str | None) -> str:
+    """Choose page encoding: HTTP header, byte order mark, <meta charset> in the first bytes, or UTF-8"""
+    for charset in (header_charset, _bom_charset(head), _sniff_meta_charset(head)):
+        if charset:
+            try:
+                return codecs.lookup(charset).name
+            except LookupError:
+                continue
+    return 'utf-8'
+
+
+def _bom_charset(head: bytes) -> str | None:
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    return None
+
+
+def _sniff_meta_charset(head: bytes) -> str | None:
+    match = _meta_charset.search(head[:4096])
+    return match.group(1).decode('ascii') if match else None
+
+
+async def read_open_graph_props(response: aiohttp.ClientResponse, max_bytes: int) -> dict:
+    """Read the response incrementally and parse it until the end of <head> or max_bytes are read"""
+    parser = OpenGraphParser()
+    decoder = None
+    head = b''
+    received = 0
+    async for chunk in response.content.iter_chunked(PARSE_CHUNK_SIZE):
+        received += len(chunk)
+        if decoder is None:
+            # Collect enough bytes to find <meta charset> before decoding
+            head += chunk
+            if len(head) < 1024 and received < max_bytes:
+                continue
+            decoder = codecs.getincrementaldecoder(detect_charset(head, response.charset))(errors='replace')
+            chunk = head
+        parser.feed(decoder.decode(chunk))
+        if parser.done or received >= max_bytes:
+            break
+    else:
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(detect_charset(head, response.charset))(errors='replace')
+            parser.feed(decoder.decode(head))
+        parser.feed(decoder.decode(b'', final=True))
+    return parser.props()
+
+
+class LinkPreviewCache:
+    """Two-tier (LRU in memory + SQLite on disk) cache of parsed link previews with TTL and negative caching"""
+    def __init__(self, ttl: int = 7 * 24 * 3600, negative_ttl: int = 3600, memory_size: int = 256,
+                 max_fetches: int = 8, per_host: int = 2, connect_timeout: float = 5, read_timeout: float = 10,
+                 max_bytes: int = 512 * 1024):
+        """
+        Parameters:
+        ttl (int): Time (in seconds) to keep successfully fetched previews.
+        negative_ttl (int): Time (in seconds) to remember that a page could not be fetched or parsed.
+        memory_size (int): Number of previews kept in memory.
+        max_fetches (int): Maximum number of pages fetched at the same time.
+        per_host (int): Maximum number of pages fetched from the same host at the same time.
+        max_bytes (int): Maximum number of bytes read from the page if </head> is not found earlier.
+        """
+        self.max_fetches = max(1, max_fetches)
+        self._session = None
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory_size = max(1, memory_size)
+        self.per_host = max(1, per_host)
+        self.timeout = aiohttp.ClientTimeout(total=connect_timeout + read_timeout,
+                                             sock_connect=connect_timeout, sock_read=read_timeout)
+        self.memory = OrderedDict()
+        # host -> [semaphore, number of fetches waiting or running], removed when there are none
+        self.hosts = {}
+        self.in_flight = {}
+
+    def session(self) -> aiohttp.ClientSession:
+        """Return the session for fetching pages, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_fetches, limit_per_host=self.per_host, keepalive_timeout=30)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _is_fresh(self, props, fetched_at: float) -> bool:
+        ttl = self.ttl if props is not None else self.negative_ttl
+        return time.time() - fetched_at < ttl
+
+    def _remember(self, url: str, props, fetched_at: float) -> None:
+        self.memory[url] = (props, fetched_at)
+        self.memory.move_to_end(url)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _lookup(self, url: str) -> tuple | None:
+        cached = self.memory.get(url)
+        if cached is not None:
+            if self._is_fresh(*cached):
+                self.memory.move_to_end(url)
+                return cached
+            del self.memory[url]
+        cached = get_link_preview(url)
+        if cached is not None and self._is_fresh(*cached):
+            self._remember(url, *cached)
+            return cached
+        return None
+
+    async def get(self, url: str) -> dict:
+        """Return OpenGraph properties of the page. Returns empty dict if the page could not be fetched or parsed"""
+        cached = self._lookup(url)
+        if cached is not None:
+            return cached[0] or {}
+
+        # The same link sent several times at once is fetched only once
+        if url not in self.in_flight:
+            self.in_flight[url] = asyncio.ensure_future(self._fetch(url))
+        try:
+            props = await asyncio.shield(self.in_flight[url])
+        finally:
+            if url in self.in_flight and self.in_flight[url].done():
+                del self.in_flight[url]
+        return props or {}
+
+    async def _fetch(self, url: str) -> dict | None:
+        host = urlsplit(url).hostname or ''
+        entry = self.hosts.get(host)
+        if entry is None:
+            entry = self.hosts[host] = [asyncio.Semaphore(self.per_host), 0]
+        entry[1] += 1
+        props = None
+        try:
+            async with entry[0]:
+                try:
+                    async with self.session().get(url, timeout=self.timeout) as response:
+                        if response.status == 200:
+                            props = await read_open_graph_props(response, self.max_bytes)
+                        else:
+                            logging.info(f'Link preview for {url} is not available: HTTP {response.status}')
+                except Exception as e:
+                    logging.info(f'Link preview for {url} is not available: {e!r}')
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.hosts[host]
+        fetched_at = time.time()
+        self._remember(url, props, fetched_at)
+        save_link_preview(url, props, fetched_at)
+        return props
+
+    def purge(self) -> None:
+        """Remove expired previews from the database"""
+        delete_link_previews(time.time() - max(self.ttl, self.negative_ttl))
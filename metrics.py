@@ -0,0 +1,174 @@
+# Metrics of tg2obsidian_bot
+# Counters and histograms are kept in memory and exposed in Prometheus text format on an optional
+# local HTTP endpoint. Gauges (queue depths) are read from their owners only when metrics are requested.
+
+import time
+import logging
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Upper bounds (in seconds) of latency buckets, from a cached answer to a long audio recording
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """Value that only grows, for example the number of downloaded bytes"""
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, value: float = 1, *label_values) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def value(self, *label_values) -> float:
+        return self.values.get(label_values, 0)
+
+    def render(self) -> list[str]:
+        return [f'{self.name}{_labels(self.labels, key)} {value}' for key, value in sorted(self.values.items())]
+
+
+class Histogram:
+    """Distribution of observed values (usually durations) over fixed buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [counts of buckets (the last one is +Inf), sum, count]
+        self.values = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *label_values) -> int:
+        series = self.values.get(label_values)
+        return series[2] if series else 0
+
+    def sum(self, *label_values) -> float:
+        series = self.values.get(label_values)
+        return series[1] if series else 0.0
+
+    def quantile(self, q: float, *label_values) -> float:
+        """Estimate the quantile by linear interpolation within the bucket, as Prometheus does"""
+        series = self.values.get(label_values)
+        if not series or not series[2]:
+            return 0.0
+        rank = q * series[2]
+        total = 0
+        for i, bucket_count in enumerate(series[0]):
+            if total + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    # Values above the largest bucket
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - total) / bucket_count
+            total += bucket_count
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, (bucket_counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = _labels(self.labels, key, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {count}')
+        return lines
+
+
+class Gauge:
+    """Current value read by a function when metrics are requested. The function returns a number, or a dict label value -> number for a gauge with one label"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, read, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = labels
+
+    def render(self) -> list[str]:
+        try:
+            value = self.read()
+        except Exception as e:
+            logging.error(f'Error reading metric {self.name}: {e}')
+            return []
+        if isinstance(value, dict):
+            return [f'{self.name}{_labels(self.labels, (key,))} {item}' for key, item in sorted(value.items())]
+        return [f'{self.name} {value}']
+
+
+class Metrics:
+    """Registry of metrics of the bot"""
+    def __init__(self):
+        self.metrics = []
+        self.started = time.time()
+        self.runner = None
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read, labels: tuple = ()) -> Gauge:
+        return self._add(Gauge(name, help, read, labels))
+
+    def uptime(self) -> float:
+        return time.time() - self.started
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host: str, port: int) -> None:
+        """Start the HTTP endpoint serving metrics on /metrics"""
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8',
+                                headers={'X-Content-Type-Options': 'nosniff'})
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host=host, port=port).start()
+        logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
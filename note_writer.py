@@ -0,0 +1,144 @@
+# Write-behind note writer for tg2obsidian_bot
+# Note blocks are queued per note file and appended in batches by one writer task per file.
+# A batch that cannot be written after a few attempts is reported to the senders of its blocks
+# and appended to a spool file, so the text is not lost.
+
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime as dt
+
+
+class NoteFile:
+    """Note blocks waiting to be appended to one note file"""
+    def __init__(self):
+        # (text, on_error) of note blocks in order
+        self.pending = []
+        self.size = 0
+        # Failed attempts to write the pending blocks
+        self.failures = 0
+        # When the oldest pending block was queued
+        self.queued_at = 0.0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+
+class NoteWriter:
+    """
+    Appends note blocks to note files off the event loop.
+    Blocks for the same file are written in the order they were queued and flushed
+    when flush_interval seconds pass or flush_size characters are pending.
+    """
+    def __init__(self, flush_interval: float = 1.0, flush_size: int = 64 * 1024, fsync: str = 'never', on_write=None,
+                 max_retries: int = 3, spool_path: str = 'unsaved_notes.md'):
+        """
+        Parameters:
+        flush_interval (float): Maximum time (in seconds) a note block waits before it is written.
+        flush_size (int): Number of pending characters that triggers writing immediately.
+        fsync (str): 'never' - leave flushing to the OS, 'batch' - fsync the file after every written batch.
+        on_write (callable): Called after every written batch with the time (in seconds) its oldest block waited
+            since it was queued and the time spent writing.
+        max_retries (int): Attempts to write a batch, flush_interval seconds apart, before it is given up.
+        spool_path (str): File the text of given up batches is appended to, with the name of the note.
+        """
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self.on_write = on_write
+        self.max_retries = max(1, max_retries)
+        self.spool_path = spool_path
+        self.files = {}
+        self.closing = False
+
+    def append(self, path: str, text: str, on_error=None) -> None:
+        """
+        Queue text to be appended to the file. Must be called from the running event loop.
+        on_error is called with the exception if the text could not be written to the file.
+        """
+        note_file = self.files.get(path)
+        if note_file is None:
+            note_file = self.files[path] = NoteFile()
+            note_file.task = asyncio.create_task(self._serve(path, note_file))
+        if not note_file.pending:
+            note_file.queued_at = time.perf_counter()
+        note_file.pending.append((text, on_error))
+        note_file.size += len(text)
+        if note_file.size >= self.flush_size or self.closing:
+            note_file.wakeup.set()
+
+    def depth(self) -> int:
+        """Number of note blocks waiting to be written"""
+        return sum(len(note_file.pending) for note_file in self.files.values())
+
+    async def close(self) -> None:
+        """Write all pending note blocks and stop writer tasks"""
+        self.closing = True
+        tasks = []
+        for note_file in list(self.files.values()):
+            note_file.wakeup.set()
+            tasks.append(note_file.task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _serve(self, path: str, note_file: NoteFile) -> None:
+        while True:
+            if not self.closing:
+                try:
+                    await asyncio.wait_for(note_file.wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            note_file.wakeup.clear()
+
+            if not note_file.pending:
+                # Nothing was queued during the interval, the task stops until the next note
+                del self.files[path]
+                return
+
+            blocks = note_file.pending
+            text = ''.join(block for block, _ in blocks)
+            note_file.pending = []
+            note_file.size = 0
+            queued_at = note_file.queued_at
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, path, text)
+                note_file.failures = 0
+                if self.on_write is not None:
+                    finished = time.perf_counter()
+                    self.on_write(finished - queued_at, finished - started)
+            except Exception as e:
+                note_file.failures += 1
+                logging.error(f'Error writing to note {path} (attempt {note_file.failures}): {e}')
+                if note_file.failures < self.max_retries and not self.closing:
+                    # Keep the blocks to retry with the next batch
+                    note_file.pending = blocks + note_file.pending
+                    note_file.size += len(text)
+                    note_file.queued_at = queued_at
+                    continue
+                note_file.failures = 0
+                await self._give_up(path, text, blocks, e)
+                if self.closing and not note_file.pending:
+                    del self.files[path]
+                    return
+
+    async def _give_up(self, path: str, text: str, blocks: list, error: Exception) -> None:
+        """Keep the text of the batch in the spool file and report the error to the senders of its blocks"""
+        try:
+            await asyncio.to_thread(self._write, self.spool_path,
+                                    f'<!-- {dt.now():%Y-%m-%d %H:%M:%S} not written to {path}: {error} -->\n{text}')
+            logging.error(f'Text not written to {path} is saved in {self.spool_path}')
+        except Exception as e:
+            logging.error(f'Error writing to {self.spool_path}: {e}. Text not written to {path}:\n{text}')
+        for _, on_error in blocks:
+            if on_error is not None:
+                try:
+                    on_error(error)
+                except Exception as e:
+                    logging.error(f'Error reporting failed write to {path}: {e}')
+
+    def _write(self, path: str, text: str) -> None:
+        with open(path, 'a', encoding='UTF-8') as f:
+            f.write(text)
+            if self.fsync == 'batch':
+                f.flush()
+                os.fsync(f.fileno())
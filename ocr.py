@@ -0,0 +1,67 @@
+# Optical character recognition for tg2obsidian_bot
+# Images are preprocessed and recognized in worker processes, so several pictures are handled in parallel
+
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _prepare_image(img, max_size: int, max_dpi: int):
+    """Convert image to grayscale and downscale it to the maximum DPI and size"""
+    from PIL import Image
+
+    img = img.convert('L')
+    scale = 1.0
+    dpi = img.info.get('dpi')
+    if max_dpi and dpi and dpi[0] and dpi[0] > max_dpi:
+        scale = max_dpi / float(dpi[0])
+    if max_size and max(img.size) * scale > max_size:
+        scale = max_size / float(max(img.size))
+    if scale < 1.0:
+        new_size = (max(1, int(img.size[0] * scale)), max(1, int(img.size[1] * scale)))
+        img = img.resize(new_size, Image.LANCZOS)
+    return img
+
+
+def _recognize(image_path: str, ocr_languages: str, max_size: int, max_dpi: int, timeout: int) -> str:
+    """Recognize text on the image in the worker process"""
+    import pytesseract
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        prepared = _prepare_image(img, max_size, max_dpi)
+        recognized_text = pytesseract.image_to_string(prepared, lang=ocr_languages, timeout=timeout)
+    return recognized_text.strip()
+
+
+class OcrEngine:
+    """Pool of worker processes running tesseract on received images"""
+    def __init__(self, workers: int = 2, max_size: int = 4000, max_dpi: int = 300, timeout: int = 60):
+        # Fail at startup rather than on the first picture if OCR dependencies are missing
+        import pytesseract
+        from PIL import Image
+
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.max_dpi = max_dpi
+        self.timeout = timeout
+        self.pool = None
+
+    async def recognize(self, image_path: str, ocr_languages: str) -> str:
+        """Recognize text on the image. Returns empty string if nothing was recognized or recognition failed"""
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        try:
+            job = loop.run_in_executor(self.pool, _recognize, image_path, ocr_languages,
+                                       self.max_size, self.max_dpi, self.timeout)
+            # tesseract is killed by pytesseract on timeout, the extra time covers image preprocessing
+            return await asyncio.wait_for(job, timeout=self.timeout + 10 if self.timeout else None)
+        except Exception as e:
+            logging.error(f'Error during text recognition from {image_path} in {ocr_languages}: {e!r}')
+            return ''
+
+    def stop(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,188 @@
+# Rate-limited Bot API calls for tg2obsidian_bot
+# Telegram allows a bot about 30 messages per second in total, about one message per second in a private chat
+# and 20 messages per minute in a group. Messages are queued per chat and sent in order without exceeding
+# these limits; when Telegram still answers 429 Too Many Requests, sending is retried after the requested time.
+# Cosmetic calls (chat actions, reactions) have the lowest priority: they are sent only when the global limit
+# leaves a reserve, so they never delay answers and file downloads.
+
+import time
+import heapq
+import asyncio
+import logging
+from itertools import count
+
+from aiogram.exceptions import TelegramRetryAfter
+
+# Priorities of calls queued for a chat, lower is sent first
+PRIORITY_MESSAGE = 0
+PRIORITY_COSMETIC = 1
+
+
+class TokenBucket:
+    """Allows rate events per second on average with bursts of up to capacity events"""
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, tokens: float = 1) -> float:
+        """Time (in seconds) until the number of tokens is available, 0 if it is available now"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class ChatOutbox:
+    """Calls waiting to be sent to one chat, ordered by priority and then by the time they were queued"""
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.jobs = []
+        self.task = None
+
+
+class Outbox:
+    """Sends messages in order within each chat, keeping to the global and per-chat limits of Telegram"""
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, group_rate: float = 20 / 60,
+                 max_retries: int = 3, cosmetic_reserve: float = 0.5):
+        """
+        Parameters:
+        global_rate (float): Messages per second to all chats together.
+        chat_rate (float): Messages per second to one private chat.
+        group_rate (float): Messages per second to one group or channel. Up to one minute of messages can be sent at once.
+        max_retries (int): How many times sending is retried after 429 Too Many Requests.
+        cosmetic_reserve (float): Part of the global limit cosmetic calls leave for messages and file downloads.
+        """
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.cosmetic_tokens = 1 + self.global_bucket.capacity * cosmetic_reserve
+        self.chats = {}
+        self.delayed = {}
+        self.sequence = count()
+
+    def send(self, chat_id: int, job, priority: int = PRIORITY_MESSAGE) -> asyncio.Future:
+        """
+        Queue a call for the chat. Await the result to wait for delivery.
+
+        Parameters:
+        chat_id (int): Chat the message is sent to.
+        job (callable): Coroutine function without arguments making the API call, for example lambda: message.answer(text).
+        priority (int): PRIORITY_MESSAGE or PRIORITY_COSMETIC.
+
+        Returns:
+        asyncio.Future: Result of the API call.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue(chat_id, job, priority, future)
+        return future
+
+    def post(self, chat_id: int, job, priority: int = PRIORITY_MESSAGE) -> None:
+        """Queue a call for the chat without waiting for delivery. Errors are logged"""
+        self._queue(chat_id, job, priority, None)
+
+    def post_later(self, chat_id: int, key: str, job, delay: float, priority: int = PRIORITY_COSMETIC) -> None:
+        """
+        Queue a call for the chat after delay seconds. If another call with the same key is posted
+        for the chat before that, the earlier call is dropped, so only the last call of a burst is made.
+        """
+        delayed = self.delayed.pop((chat_id, key), None)
+        if delayed is not None:
+            delayed[0].cancel()
+        handle = asyncio.get_running_loop().call_later(delay, self._post_delayed, chat_id, key)
+        self.delayed[(chat_id, key)] = (handle, job, priority)
+
+    async def call(self, job):
+        """
+        Make an API call not related to a chat (for example, get_file) as soon as the global limit allows.
+        Such calls are not queued and go before cosmetic calls, which wait for the reserve.
+        """
+        retries = 0
+        while True:
+            delay = self.global_bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self.global_bucket.take()
+            try:
+                return await job()
+            except TelegramRetryAfter as e:
+                if retries >= self.max_retries:
+                    raise
+                retries += 1
+                logging.info(f'Too many requests, retrying in {e.retry_after} s')
+                await asyncio.sleep(e.retry_after)
+
+    def depth(self) -> int:
+        """Number of calls waiting to be sent"""
+        return sum(len(chat.jobs) for chat in self.chats.values()) + len(self.delayed)
+
+    async def close(self) -> None:
+        """Send all queued calls, including delayed ones"""
+        for chat_id, key in list(self.delayed):
+            self.delayed[(chat_id, key)][0].cancel()
+            self._post_delayed(chat_id, key)
+        await asyncio.gather(*[chat.task for chat in self.chats.values()], return_exceptions=True)
+
+    def _post_delayed(self, chat_id: int, key: str) -> None:
+        _, job, priority = self.delayed.pop((chat_id, key))
+        self.post(chat_id, job, priority)
+
+    def _queue(self, chat_id: int, job, priority: int, future: asyncio.Future | None) -> None:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            # Ids of groups and channels are negative
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, max(1, self.group_rate * 60))
+            else:
+                bucket = TokenBucket(self.chat_rate)
+            chat = self.chats[chat_id] = ChatOutbox(bucket)
+            chat.task = asyncio.create_task(self._serve(chat_id, chat))
+        heapq.heappush(chat.jobs, (priority, next(self.sequence), 0, job, future))
+
+    async def _serve(self, chat_id: int, chat: ChatOutbox) -> None:
+        while chat.jobs:
+            # The first call is chosen again after waiting, a more important one may be queued meanwhile
+            priority, sequence, retries, job, future = chat.jobs[0]
+            if priority == PRIORITY_COSMETIC:
+                # Cosmetic calls do not use up the limit of messages to the chat
+                delay = self.global_bucket.delay(self.cosmetic_tokens)
+            else:
+                delay = max(chat.bucket.delay(), self.global_bucket.delay())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(chat.jobs)
+            if priority != PRIORITY_COSMETIC:
+                chat.bucket.take()
+            self.global_bucket.take()
+            try:
+                result = await job()
+            except TelegramRetryAfter as e:
+                if retries < self.max_retries:
+                    logging.info(f'Too many requests to chat {chat_id}, retrying in {e.retry_after} s')
+                    heapq.heappush(chat.jobs, (priority, sequence, retries + 1, job, future))
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                self._fail(chat_id, future, e)
+            except Exception as e:
+                self._fail(chat_id, future, e)
+            else:
+                if future is not None and not future.cancelled():
+                    future.set_result(result)
+        # Nothing to send, the task stops until the next call to the chat
+        del self.chats[chat_id]
+
+    @staticmethod
+    def _fail(chat_id: int, future: asyncio.Future | None, e: Exception) -> None:
+        if future is None:
+            logging.error(f'Error sending to chat {chat_id}: {e}')
+        elif not future.cancelled():
+            future.set_exception(e)
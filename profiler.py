@@ -0,0 +1,248 @@
+# Profiling of updates processed by tg2obsidian_bot
+# A part of updates is profiled with cProfile from start to end. An update running longer than the threshold
+# is profiled from that moment to its end, and the place it was waiting at that moment is recorded.
+# Profiles are written to a folder keeping only the newest files, and summarized by this script:
+#
+# Usage:
+#   python profiler.py [profiles] [--top 30] [--sort cumulative] [--handler handle_photo] [--reason slow]
+#
+# cProfile measures the whole event loop thread, so other updates processed at the same time are included
+# in the profile, and work done in threads or worker processes (file writes, OCR, speech recognition) is not.
+# Only one update is profiled at a time.
+
+import os
+import sys
+import json
+import time
+import pstats
+import random
+import asyncio
+import cProfile
+import logging
+import argparse
+import traceback
+import tracemalloc
+from datetime import datetime as dt
+
+# Number of lines of memory allocation statistics kept for a profiled update
+MEMORY_TOP = 30
+
+
+class ProfiledUpdate:
+    """Update being processed and what was recorded about it"""
+    def __init__(self, update_type: str, handler: str):
+        self.update_type = update_type
+        self.handler = handler
+        self.coro = None
+        self.started = time.perf_counter()
+        self.started_at = dt.now()
+        self.reason = ''
+        self.profiled_after = 0.0
+        self.slow_after = 0.0
+        self.stack = ''
+        self.memory_before = None
+
+
+class UpdateProfiler:
+    """Profiles sampled and slow updates and writes profiles to a folder"""
+    def __init__(self, path: str = 'profiles', sample_rate: float = 0, slow_threshold: float = 0,
+                 memory: bool = False, max_files: int = 100):
+        """
+        Parameters:
+        path (str): Folder for profiles.
+        sample_rate (float): Part of updates profiled from start to end, 0 - none, 1 - all.
+        slow_threshold (float): Time (in seconds) after which an update is considered slow. 0 - do not trace slow updates.
+        memory (bool): Record memory allocations (tracemalloc) of profiled updates.
+        max_files (int): Number of profiles kept, older ones are removed.
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.memory = memory
+        self.max_files = max(1, max_files)
+        # Update profiled now and its profiler
+        self.active = None
+        self.profile = None
+        self.tracing = False
+
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_threshold > 0
+
+    async def run(self, job, update_type: str, handler: str):
+        """Run the coroutine function job processing the update, profiling it if it is sampled or slow"""
+        update = ProfiledUpdate(update_type, handler)
+        if self.active is None and random.random() < self.sample_rate:
+            update.reason = 'sampled'
+            self._start(update)
+        slow = None
+        if self.slow_threshold > 0:
+            slow = asyncio.get_running_loop().call_later(self.slow_threshold, self._slow, update)
+        try:
+            update.coro = job()
+            return await update.coro
+        finally:
+            if slow is not None:
+                slow.cancel()
+            if update.reason:
+                await self._finish(update)
+
+    def _slow(self, update: ProfiledUpdate) -> None:
+        """The update runs longer than the threshold: record where it waits and profile the rest of it"""
+        update.slow_after = time.perf_counter() - update.started
+        if update.coro is not None:
+            update.stack = awaited_stack(update.coro)
+        if update.reason:
+            # Sampled, so it is profiled already
+            return
+        update.reason = 'slow'
+        if self.active is None:
+            update.profiled_after = update.slow_after
+            self._start(update)
+
+    def _start(self, update: ProfiledUpdate) -> None:
+        self.active = update
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.tracing = True
+            update.memory_before = tracemalloc.take_snapshot()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    async def _finish(self, update: ProfiledUpdate) -> None:
+        elapsed = time.perf_counter() - update.started
+        profile = None
+        memory = []
+        if self.active is update:
+            self.profile.disable()
+            profile = self.profile
+            self.profile = None
+            self.active = None
+            if update.memory_before is not None:
+                statistics = tracemalloc.take_snapshot().compare_to(update.memory_before, 'lineno')
+                memory = [str(line) for line in statistics[:MEMORY_TOP]]
+                if self.tracing:
+                    # Tracing slows down everything, it is kept only while an update is profiled
+                    tracemalloc.stop()
+                    self.tracing = False
+
+        info = {
+            'update_type': update.update_type,
+            'handler': update.handler,
+            'reason': update.reason,
+            'started_at': update.started_at.isoformat(timespec='milliseconds'),
+            'elapsed': round(elapsed, 3),
+            # Slow updates are profiled only from the moment they became slow, or not at all if another update was profiled
+            'profiled_after': round(update.profiled_after, 3),
+            'profiled': profile is not None,
+            # Where the update was waiting when it became slow
+            'slow_after': round(update.slow_after, 3),
+            'stack': update.stack,
+            'memory': memory,
+        }
+        try:
+            await asyncio.to_thread(self._write, info, profile)
+        except Exception as e:
+            logging.error(f'Error writing profile of {update.handler}: {e}')
+
+    def _write(self, info: dict, profile: cProfile.Profile | None) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        name = f'{info["started_at"].replace(":", "-")}_{info["update_type"]}_{info["handler"]}_{info["elapsed"]:.1f}s'
+        stem = os.path.join(self.path, name)
+        if profile is not None:
+            profile.dump_stats(stem + '.prof')
+        with open(stem + '.json', 'w', encoding='UTF-8') as f:
+            json.dump(info, f, ensure_ascii=False, indent=1)
+        logging.info(f'Profile of {info["reason"]} update ({info["handler"]}, {info["elapsed"]:.1f} s) written to {stem}.json')
+        self._rotate()
+
+    def _rotate(self) -> None:
+        """Remove the oldest profiles above max_files. Names start with the time, so they are sorted by age"""
+        stems = sorted(name[:-len('.json')] for name in os.listdir(self.path) if name.endswith('.json'))
+        for stem in stems[:-self.max_files]:
+            for extension in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.path, stem + extension))
+                except FileNotFoundError:
+                    pass
+
+
+def awaited_stack(coro) -> str:
+    """Format the chain of coroutines the suspended coroutine is waiting for, ending with the awaited object"""
+    frames = []
+    awaited = coro
+    while awaited is not None:
+        frame = getattr(awaited, 'cr_frame', None) or getattr(awaited, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append((frame, frame.f_lineno))
+        awaited = getattr(awaited, 'cr_await', None) or getattr(awaited, 'gi_yieldfrom', None)
+    stack = ''.join(traceback.format_list(traceback.StackSummary.extract(frames)))
+    if awaited is not None:
+        # Usually a future of a thread, a worker process or a network request
+        stack += f'  Awaiting {repr(awaited)[:300]}\n'
+    return stack
+
+
+def load_profiles(path: str, handler: str = '', reason: str = '') -> list[tuple[str, dict]]:
+    """Return (file name without extension, info) of profiles in the folder, oldest first"""
+    profiles = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(path, name), encoding='UTF-8') as f:
+            info = json.load(f)
+        if (handler and info.get('handler') != handler) or (reason and info.get('reason') != reason):
+            continue
+        profiles.append((os.path.join(path, name[:-len('.json')]), info))
+    return profiles
+
+
+def report(profiles: list[tuple[str, dict]], top: int = 30, sort: str = 'cumulative', out=sys.stdout) -> None:
+    """Print profiled updates by handler, the slowest of them with their stacks and top functions of all profiles"""
+    handlers = {}
+    for _, info in profiles:
+        handlers.setdefault((info['update_type'], info['handler']), []).append(info['elapsed'])
+    print(f'{len(profiles)} profiled updates', file=out)
+    for (update_type, handler), times in sorted(handlers.items(), key=lambda item: -sum(item[1])):
+        print(f'  {handler} ({update_type}): {len(times)}, average {sum(times) / len(times):.2f} s, max {max(times):.2f} s', file=out)
+
+    slowest = sorted(profiles, key=lambda profile: -profile[1]['elapsed'])[:5]
+    for stem, info in slowest:
+        print(f'\n{info["started_at"]} {info["handler"]} {info["elapsed"]:.2f} s ({info["reason"]}): {os.path.basename(stem)}', file=out)
+        if info.get('stack'):
+            print(f'  Waiting after {info.get("slow_after", 0):.2f} s at:', file=out)
+            print(''.join(f'  {line}\n' for line in info['stack'].rstrip().split('\n')), end='', file=out)
+        for line in info.get('memory', [])[:10]:
+            print(f'  {line}', file=out)
+
+    files = [stem + '.prof' for stem, _ in profiles if os.path.exists(stem + '.prof')]
+    if files:
+        stats = pstats.Stats(files[0], stream=out)
+        for file in files[1:]:
+            stats.add(file)
+        print(f'\nTop {top} functions of {len(files)} profiles by {sort} time:', file=out)
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Summarize profiles of sampled and slow updates written by the bot')
+    parser.add_argument('path', nargs='?', default=None, help='folder with profiles (default: profile_path from config.py)')
+    parser.add_argument('--top', type=int, default=30, help='number of functions to show')
+    parser.add_argument('--sort', default='cumulative', choices=('cumulative', 'tottime', 'ncalls'), help='order of functions')
+    parser.add_argument('--handler', default='', help='only updates processed by this handler, for example handle_photo')
+    parser.add_argument('--reason', default='', choices=('', 'sampled', 'slow'), help='only sampled or only slow updates')
+    args = parser.parse_args()
+
+    path = args.path
+    if path is None:
+        import config
+        path = getattr(config, 'profile_path', 'profiles')
+    if not os.path.isdir(path):
+        print(f'No profiles in {path}', file=sys.stderr)
+        sys.exit(1)
+    report(load_profiles(path, args.handler, args.reason), args.top, args.sort)
+
+
+if __name__ == '__main__':
+    main()
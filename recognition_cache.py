@@ -0,0 +1,148 @@
+# Cache of recognized text for tg2obsidian_bot
+# Transcripts of audio and text recognized on images are kept in bot_settings.db by Telegram file_unique_id,
+# which is the same for the file in any chat and in any forward, so a file sent again is not recognized again.
+# Results are stored together with the engine, model and language, so changing them never returns old text.
+#
+# Usage:
+#   python recognition_cache.py stats
+#   python recognition_cache.py warm     recognize text on images already stored in photo_path
+#   python recognition_cache.py clear [--engine ocr|stt]
+
+import os
+import time
+import asyncio
+import logging
+import argparse
+
+import config
+from database import (get_recognition_result, save_recognition_result, get_recognition_results_size,
+                      delete_recognition_results, delete_stale_recognition_results, clear_recognition_results,
+                      list_attachments, close_connection)
+
+# Engines whose results are cached
+ENGINE_OCR = 'ocr'
+ENGINE_STT = 'stt'
+
+
+class RecognitionCache:
+    """Persistent cache of recognition results with limits on age and total size, least recently used removed first"""
+    def __init__(self, max_age: int = 180 * 24 * 3600, max_size: int = 50 * 1024 * 1024):
+        """
+        Parameters:
+        max_age (int): Time (in seconds) to keep results not used since then.
+        max_size (int): Total size (in bytes) of cached text.
+        """
+        self.max_age = max_age
+        self.max_size = max_size
+        self.size = None
+        self.in_flight = {}
+
+    def get(self, file_key: str, engine: str, model: str, language: str) -> str | None:
+        """Return the stored text, or None if the file was not recognized with these settings"""
+        return get_recognition_result(file_key, engine, model, language, time.time())
+
+    def put(self, file_key: str, engine: str, model: str, language: str, text: str) -> None:
+        save_recognition_result(file_key, engine, model, language, text, time.time())
+        if self.size is None:
+            self.size = get_recognition_results_size()[1]
+        else:
+            self.size += len(text.encode())
+        if self.size > self.max_size:
+            self.purge()
+
+    async def get_or_create(self, file_key: str, engine: str, model: str, language: str, create,
+                            keep_empty: bool = True) -> str:
+        """
+        Return the stored text or recognize it and store the result.
+
+        Parameters:
+        file_key (str): Telegram file_unique_id or hash of the file contents.
+        create (callable): Coroutine function without arguments recognizing the text.
+        keep_empty (bool): Store empty results. Turn off if recognition returns empty text on errors.
+
+        Returns:
+        str: Recognized text.
+        """
+        text = self.get(file_key, engine, model, language)
+        if text is not None:
+            logging.info(f'Recognized text of {file_key} ({engine}, {model}, {language}) is taken from cache')
+            return text
+
+        # The same file sent to several chats at once is recognized only once
+        key = (file_key, engine, model, language)
+        if key not in self.in_flight:
+            self.in_flight[key] = asyncio.ensure_future(self._create(key, create, keep_empty))
+        try:
+            return await asyncio.shield(self.in_flight[key])
+        finally:
+            if key in self.in_flight and self.in_flight[key].done():
+                del self.in_flight[key]
+
+    async def _create(self, key: tuple, create, keep_empty: bool) -> str:
+        text = await create()
+        if text or keep_empty:
+            self.put(*key, text)
+        return text
+
+    def invalidate(self, engine: str, model: str, language: str) -> None:
+        """Remove results of the engine made with another model or language, they will not be used any more"""
+        deleted = delete_stale_recognition_results(engine, model, language)
+        if deleted:
+            logging.info(f'Removed {deleted} cached {engine} results of other models or languages')
+            self.size = None
+
+    def purge(self) -> None:
+        """Remove results not used for max_age and the least recently used ones above max_size"""
+        delete_recognition_results(time.time() - self.max_age, self.max_size)
+        self.size = get_recognition_results_size()[1]
+
+
+async def warm(jobs: int) -> None:
+    """Recognize text on images already stored in photo_path, so it is not recognized when they are sent again"""
+    # The bot module creates the cache itself, so it is imported only here
+    import tg2obsidian_bot as bot_module
+
+    if not config.ocr:
+        print('OCR is turned off in config.py, nothing to recognize')
+        return
+    images = [(file_unique_id, file_name) for file_unique_id, file_name in list_attachments()
+              if os.path.splitext(file_name)[1].lower() in ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+              and os.path.exists(os.path.join(config.photo_path, file_name))]
+    semaphore = asyncio.Semaphore(max(1, jobs))
+    done = 0
+
+    async def recognize(file_unique_id: str, file_name: str) -> None:
+        nonlocal done
+        async with semaphore:
+            await bot_module.recognize_text_from_image(os.path.join(config.photo_path, file_name),
+                                                       bot_module.ocr_languages, file_unique_id)
+        done += 1
+        print(f'\r{done:,} of {len(images):,} images', end='', flush=True)
+
+    try:
+        await asyncio.gather(*[recognize(*image) for image in images])
+    finally:
+        bot_module.ocr_engine.stop()
+    print()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Manage cached results of text recognition on images and speech recognition')
+    parser.add_argument('command', choices=('stats', 'warm', 'clear'))
+    parser.add_argument('--engine', choices=(ENGINE_OCR, ENGINE_STT), default='', help='results of this engine only (clear)')
+    parser.add_argument('--jobs', type=int, default=2, help='number of images recognized in parallel (warm)')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'warm':
+            asyncio.run(warm(args.jobs))
+        elif args.command == 'clear':
+            print(f'Removed {clear_recognition_results(args.engine):,} results')
+        count, size = get_recognition_results_size()
+        print(f'{count:,} results, {size / 2**20:,.1f} MB cached')
+    finally:
+        close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Configuration snapshot for tg2obsidian_bot
+# Values from config.py are read once into a frozen object with derived values (time zone, keyword rules)
+# precomputed. When config.py changes, a new snapshot is built and swapped in without restarting the bot.
+
+import os
+import asyncio
+import logging
+import importlib.util
+from dataclasses import dataclass
+from datetime import tzinfo
+
+from pytz import timezone
+
+import config
+from keywords import KeywordRules
+
+
+@dataclass(frozen=True)
+class Settings:
+    allowed_chats: frozenset
+    inbox_path: str
+    photo_path: str
+    format_messages: bool
+    one_line_note: bool
+    create_link_info: bool
+    delete_messages: bool
+    message_timestamp_interval: float
+    time_zone: tzinfo
+    note_name_template: str
+    note_prefix: str
+    note_postfix: str
+    note_date: bool
+    negative_tag: str
+    keyword_rules: KeywordRules
+
+
+def build_settings(module) -> Settings:
+    """Make up settings snapshot from the config module, applying the same defaults as before"""
+    return Settings(
+        allowed_chats=frozenset(int(x) for x in module.allowed_chats.split(':')),
+        inbox_path=module.inbox_path,
+        photo_path=module.photo_path,
+        format_messages=bool(getattr(module, 'format_messages', True)),
+        one_line_note=bool(getattr(module, 'one_line_note', False)),
+        create_link_info=bool(getattr(module, 'create_link_info', False)),
+        delete_messages=bool(getattr(module, 'delete_messages', False)),
+        message_timestamp_interval=module.message_timestamp_interval,
+        time_zone=timezone(module.time_zone),
+        note_name_template=module.note_name_template,
+        note_prefix=getattr(module, 'note_prefix', ''),
+        note_postfix=getattr(module, 'note_postfix', ''),
+        note_date=getattr(module, 'note_date', False) is True,
+        negative_tag=getattr(module, 'negative_tag', ''),
+        keyword_rules=build_keyword_rules(module),
+    )
+
+
+def build_keyword_rules(module) -> KeywordRules:
+    """Compile task keywords, negative keywords and keyword_tags into one set of rules"""
+    tag_keywords = {}
+    negative_keywords = getattr(module, 'negative_keywords', ())
+    if negative_keywords:
+        tag_keywords[getattr(module, 'negative_tag', '')] = set(negative_keywords)
+    for tag, keywords in getattr(module, 'keyword_tags', {}).items():
+        tag_keywords.setdefault(tag, set()).update(keywords)
+    return KeywordRules(getattr(module, 'task_keywords', ()), tag_keywords)
+
+
+_current = build_settings(config)
+_config_mtime = os.path.getmtime(config.__file__)
+
+
+def current() -> Settings:
+    """Return the current settings snapshot"""
+    return _current
+
+
+def reload() -> bool:
+    """
+    Re-read config.py into a new module and swap settings snapshot if it is valid.
+    On success the config module is updated too, so values read directly from it are consistent with the snapshot.
+    Returns True if settings were reloaded.
+    """
+    global _current
+    try:
+        spec = importlib.util.spec_from_file_location('config', config.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        new_settings = build_settings(module)
+    except Exception as e:
+        logging.error(f'Configuration is not reloaded, error in {config.__file__}: {e}')
+        return False
+
+    new_values = {name: value for name, value in vars(module).items() if not name.startswith('__')}
+    for name in [name for name in vars(config) if not name.startswith('__') and name not in new_values]:
+        delattr(config, name)
+    vars(config).update(new_values)
+    _current = new_settings
+    logging.info(f'Configuration reloaded from {config.__file__}')
+    return True
+
+
+async def watch(interval: float = 5) -> None:
+    """Reload settings whenever config.py is modified. Runs until cancelled"""
+    global _config_mtime
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mtime = os.path.getmtime(config.__file__)
+        except OSError:
+            continue
+        if mtime != _config_mtime:
+            _config_mtime = mtime
+            reload()
@@ -0,0 +1,63 @@
+# Speech recognition backends for tg2obsidian_bot
+# A backend is created in every speech recognition worker process and turns audio (a file or 16 kHz mono
+# float32 samples) into a list of segments with 'start', 'end' (in seconds) and 'text'.
+# Libraries are imported by the backend, so only the selected one has to be installed.
+
+
+class WhisperBackend:
+    """Reference OpenAI Whisper model running on PyTorch"""
+    def __init__(self, model_name: str, device: str = 'cpu', compute_type: str = '', cpu_threads: int = 0):
+        import torch
+        import whisper
+
+        if device == 'cpu':
+            torch.cuda.is_available = lambda : False
+        if cpu_threads:
+            torch.set_num_threads(cpu_threads)
+
+        self.model = whisper.load_model(model_name)
+
+        if device == 'cuda' and torch.cuda.is_available():
+            self.model = self.model.to('cuda')
+        else:
+            self.model = self.model.to('cpu')
+        self.device = device
+
+    def transcribe(self, audio, language: str) -> list[dict]:
+        import torch
+
+        result = self.model.transcribe(audio, verbose=False, language=language)
+
+        if self.device == 'cuda' and torch.cuda.is_available():
+            # Clear GPU memory
+            torch.cuda.empty_cache()
+
+        if not hasattr(result['segments'], '__iter__'):
+            return []
+        return [{'start': segment['start'], 'end': segment['end'], 'text': segment['text']} for segment in result['segments']]
+
+
+class FasterWhisperBackend:
+    """Whisper model converted to CTranslate2 (faster-whisper), several times faster on CPU with int8 weights"""
+    def __init__(self, model_name: str, device: str = 'cpu', compute_type: str = 'int8', cpu_threads: int = 0):
+        from faster_whisper import WhisperModel
+
+        self.model = WhisperModel(model_name, device=device, compute_type=compute_type or 'int8', cpu_threads=cpu_threads)
+
+    def transcribe(self, audio, language: str) -> list[dict]:
+        segments, _ = self.model.transcribe(audio, language=language)
+        # Segments are recognized while the generator is consumed
+        return [{'start': segment.start, 'end': segment.end, 'text': segment.text} for segment in segments]
+
+
+BACKENDS = {
+    'whisper': WhisperBackend,
+    'faster-whisper': FasterWhisperBackend,
+}
+
+
+def create_backend(name: str, model_name: str, device: str = 'cpu', compute_type: str = '', cpu_threads: int = 0):
+    """Create the speech recognition backend by its name in config"""
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown speech recognition backend {name!r}, possible values: {", ".join(BACKENDS)}')
+    return BACKENDS[name](model_name, device, compute_type, cpu_threads)
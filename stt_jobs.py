@@ -0,0 +1,214 @@
+# Speech-to-text job queue for tg2obsidian_bot
+# Whisper models live in worker processes, so transcription never blocks the bot's event loop.
+# Worker processes (and models) are started on the first job and stopped after some idle time,
+# which returns all memory held by the models to the system.
+# Audio is decoded once, silence is dropped and speech is split into segments recognized by all workers in parallel.
+
+import time
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from audio_segments import SAMPLE_RATE, MIN_SEGMENT_LENGTH, decode_audio, speech_segments
+from stt_backends import BACKENDS, create_backend
+
+# Worker process state. Each worker holds its own copy of the model.
+_backend = None
+
+
+def _init_worker(backend: str, model_name: str, device: str, compute_type: str, cpu_threads: int) -> None:
+    """Load the model once per worker process"""
+    global _backend
+    _backend = create_backend(backend, model_name, device, compute_type, cpu_threads)
+
+
+def _transcribe(audio, language: str) -> list[dict]:
+    """
+    Transcribe audio in the worker process. Returns a list of segments with 'start', 'end' and 'text'.
+    Audio is a file path or 16 kHz mono 16-bit samples.
+    """
+    if not isinstance(audio, str):
+        audio = audio.astype('float32') / 32768
+    return _backend.transcribe(audio, language)
+
+
+class SttJob:
+    """Audio file waiting for transcription and the future receiving its segments"""
+    def __init__(self, audio_file_path: str, future: asyncio.Future):
+        self.audio_file_path = audio_file_path
+        self.future = future
+
+
+class SttQueue:
+    """Bounded queue of transcription jobs served by a pool of Whisper worker processes"""
+    def __init__(self, model_name: str, device: str = 'cpu', language: str = 'ru', workers: int = 1, max_queue: int = 10,
+                 idle_timeout: float = 600, backend: str = 'whisper', compute_type: str = '', cpu_threads: int = 0,
+                 segment_length: float = 30, min_silence: float = 0.5, on_recognized=None):
+        """
+        Parameters:
+        idle_timeout (float): Time (in seconds) without jobs after which worker processes are stopped. 0 - never stop them.
+        backend (str): Speech recognition backend, one of stt_backends.BACKENDS.
+        compute_type (str): Type of weights for faster-whisper backend (int8, int8_float16, float16, float32).
+        cpu_threads (int): Number of CPU threads used by each worker, 0 - library default.
+        segment_length (float): Maximum length (in seconds) of speech segments recognized in parallel, at least MIN_SEGMENT_LENGTH. 0 - recognize the whole file at once.
+        min_silence (float): Pauses shorter than this (in seconds) do not split speech into segments.
+        on_recognized (callable): Called with the length of the audio and the time spent recognizing it (in seconds).
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown speech recognition backend {backend!r}, possible values: {", ".join(BACKENDS)}')
+        self.backend = backend
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        if 0 < segment_length < MIN_SEGMENT_LENGTH:
+            logging.warning(f'Speech segments cannot be shorter than {MIN_SEGMENT_LENGTH} s, stt_segment_length = {segment_length} is raised to it')
+            segment_length = MIN_SEGMENT_LENGTH
+        self.segment_length = max(0, segment_length)
+        self.min_silence = min_silence
+        self.on_recognized = on_recognized
+        self.model_name = model_name
+        self.device = device
+        self.language = language
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.idle_timeout = idle_timeout
+        self.pool = None
+        self.queue = None
+        self.tasks = []
+        self.busy = 0
+        self.unload_handle = None
+
+    def start(self) -> None:
+        """Start dispatcher tasks. Must be called from the running event loop. Models are loaded on the first job"""
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.tasks = [asyncio.create_task(self._serve()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Cancel pending jobs and stop worker processes"""
+        if self.unload_handle is not None:
+            self.unload_handle.cancel()
+            self.unload_handle = None
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.queue is not None:
+            while not self.queue.empty():
+                job = self.queue.get_nowait()
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError('Speech recognition was stopped'))
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def submit(self, audio_file_path: str) -> asyncio.Future:
+        """Put audio file into the queue. Returns a future resolved with the list of recognized segments"""
+        if self.queue is None:
+            raise RuntimeError('Speech recognition is not started')
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait(SttJob(audio_file_path, future))
+        except asyncio.QueueFull:
+            raise RuntimeError(f'Speech recognition queue is full ({self.max_queue} jobs), please try again later')
+        return future
+
+    def depth(self) -> int:
+        """Number of jobs waiting for a free worker"""
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def loaded(self) -> bool:
+        """Check if worker processes with models are running"""
+        return self.pool is not None
+
+    def _load(self) -> None:
+        if self.unload_handle is not None:
+            self.unload_handle.cancel()
+            self.unload_handle = None
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            initializer=_init_worker,
+                                            initargs=(self.backend, self.model_name, self.device, self.compute_type, self.cpu_threads))
+            logging.info(f'Loading {self.model_name} speech recognition model ({self.backend}) on {self.device}')
+
+    def _unload(self) -> None:
+        self.unload_handle = None
+        if self.busy or not self.queue.empty() or self.pool is None:
+            return
+        # Worker processes exit, so memory of the models (including GPU memory) is freed completely
+        self.pool.shutdown(wait=False)
+        self.pool = None
+        logging.info(f'Speech recognition model unloaded after {self.idle_timeout} s without jobs')
+
+    def _drop_pool(self, pool: ProcessPoolExecutor) -> None:
+        """Forget the broken pool, so the next job starts new worker processes"""
+        if self.pool is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def _recognize(self, audio_file_path: str) -> tuple[list[dict], float]:
+        """Recognize the file. Returns segments and the length of the audio"""
+        # A worker process killed (for example, out of memory) or failing to load the model breaks the whole pool.
+        # The pool is started again and the file is recognized once more.
+        for attempt in range(2):
+            self._load()
+            pool = self.pool
+            try:
+                if self.segment_length > 0:
+                    return await self._transcribe_segments(pool, audio_file_path)
+                segments = await asyncio.get_running_loop().run_in_executor(pool, _transcribe, audio_file_path, self.language)
+                # The whole file is not decoded here, the end of the last segment is close to its length
+                return segments, segments[-1]['end'] if segments else 0
+            except BrokenProcessPool as e:
+                logging.error(f'Speech recognition worker process stopped unexpectedly: {e}')
+                self._drop_pool(pool)
+                if attempt:
+                    raise
+
+    async def _serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            self.busy += 1
+            started = time.perf_counter()
+            try:
+                segments, duration = await self._recognize(job.audio_file_path)
+                if self.on_recognized is not None and duration:
+                    self.on_recognized(duration, time.perf_counter() - started)
+                if not job.future.done():
+                    job.future.set_result(segments)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError('Speech recognition was stopped'))
+                raise
+            except Exception as e:
+                logging.error(f'Error during recognition of {job.audio_file_path}: {e}')
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
+                if self.idle_timeout > 0 and not self.busy and self.queue.empty():
+                    if self.unload_handle is not None:
+                        self.unload_handle.cancel()
+                    self.unload_handle = loop.call_later(self.idle_timeout, self._unload)
+
+    async def _transcribe_segments(self, pool: ProcessPoolExecutor, audio_file_path: str) -> tuple[list[dict], float]:
+        """Recognize speech segments of the file in parallel and put recognized segments back in order. Returns segments and the length of the audio"""
+        loop = asyncio.get_running_loop()
+        samples = await asyncio.to_thread(decode_audio, audio_file_path)
+        spans = await asyncio.to_thread(speech_segments, samples, self.segment_length, self.min_silence)
+        if len(spans) > 1:
+            logging.info(f'Recognizing {len(spans)} speech segments of {audio_file_path} '
+                         f'({sum(end - start for start, end in spans) / SAMPLE_RATE:.0f} of {len(samples) / SAMPLE_RATE:.0f} s)')
+        results = await asyncio.gather(*[loop.run_in_executor(pool, _transcribe, samples[start:end], self.language)
+                                         for start, end in spans], return_exceptions=True)
+        # All segments are awaited, so errors of the other segments (the same broken pool) are not left unretrieved
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        segments = []
+        for (start, _), result in zip(spans, results):
+            offset = start / SAMPLE_RATE
+            segments += [{'start': segment['start'] + offset, 'end': segment['end'] + offset, 'text': segment['text']}
+                         for segment in result]
+        return segments, len(samples) / SAMPLE_RATE
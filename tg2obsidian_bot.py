@@ -5,16 +5,14 @@
 
 import os
 import re
-import logging
-import aiohttp
 import time
+import logging
 import asyncio
-import aiofiles
+import signal
+import ssl
 
 from pathlib import Path
 from datetime import datetime as dt
-from bs4 import BeautifulSoup
-from pytz import timezone
 import urllib.request
 
 from aiogram import Bot, Dispatcher, F, types, BaseMiddleware
@@ -24,51 +22,186 @@ from aiogram.types.reaction_type_emoji import ReactionTypeEmoji
 from aiogram.enums import ParseMode
 from aiogram.methods.set_message_reaction import SetMessageReaction
 from aiogram.utils.text_decorations import html_decoration
-from database import set_notes_folder, get_notes_folder
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from albums import Album, AlbumCollector
+from chat_queues import ChatScheduler
+from database import set_notes_folder, get_notes_folder, find_attachment, find_attachments_by_hash, save_attachment, close_connection
+from downloader import Downloader
+from file_names import FileNameAllocator
+from link_preview import LinkPreviewCache, get_open_graph_props
+from metrics import Metrics
+from note_writer import NoteWriter
+from outbox import Outbox, PRIORITY_COSMETIC
+from profiler import UpdateProfiler
+from recognition_cache import RecognitionCache, ENGINE_OCR, ENGINE_STT
 
 import config
-allowed_chats = [int(x) for x in config.allowed_chats.split(':')]
+import settings
 
 # Для группировки отправленных вместе сообщений
 last_message_times = {}
 
+# Task reloading settings when config.py changes
+config_watcher = None
+
+# Metrics are shown by /stats command and served to Prometheus if metrics_port is set
+metrics = Metrics()
+update_seconds = metrics.histogram('tg2obsidian_update_seconds', 'Time from receiving an update to the end of its processing')
+update_wait_seconds = metrics.histogram('tg2obsidian_update_wait_seconds', 'Time an update waits in the chat queue and for the rest of its album')
+handler_seconds = metrics.histogram('tg2obsidian_handler_seconds', 'Time spent in the message handler', ('handler',))
+handler_errors = metrics.counter('tg2obsidian_handler_errors_total', 'Exceptions raised by message handlers', ('handler',))
+download_seconds = metrics.histogram('tg2obsidian_download_seconds', 'Time to download a file from Telegram')
+download_bytes = metrics.counter('tg2obsidian_download_bytes_total', 'Size of files downloaded from Telegram')
+ocr_seconds = metrics.histogram('tg2obsidian_ocr_seconds', 'Time to recognize text on an image, including waiting for a free worker')
+stt_seconds = metrics.histogram('tg2obsidian_stt_seconds', 'Time to recognize speech in an audio file')
+stt_audio_seconds = metrics.counter('tg2obsidian_stt_audio_seconds_total', 'Length of recognized audio')
+stt_real_time_factor = metrics.histogram('tg2obsidian_stt_real_time_factor', 'Time to recognize speech divided by the length of the audio',
+                                         buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5))
+note_write_seconds = metrics.histogram('tg2obsidian_note_write_seconds', 'Time to append a batch of note blocks to the note file')
+note_delay_seconds = metrics.histogram('tg2obsidian_note_delay_seconds', 'Time from queueing a note block to writing it to the note file')
+
+# Sampled and slow updates are profiled to find where the time goes
+profiler = UpdateProfiler(path=getattr(config, 'profile_path', 'profiles'),
+                          sample_rate=getattr(config, 'profile_sample_rate', 0),
+                          slow_threshold=getattr(config, 'profile_slow_threshold', 0),
+                          memory=getattr(config, 'profile_memory', False),
+                          max_files=getattr(config, 'profile_max_files', 100))
+
+def note_written(delay: float, duration: float) -> None:
+    note_delay_seconds.observe(delay)
+    note_write_seconds.observe(duration)
+
+def speech_recognized(audio_length: float, duration: float) -> None:
+    stt_seconds.observe(duration)
+    stt_audio_seconds.inc(audio_length)
+    stt_real_time_factor.observe(duration / audio_length)
+
+# Unique names of attachment files are reserved without probing all existing files
+file_names = FileNameAllocator()
+
+# Shared HTTP session for downloading files from Telegram
+downloader = Downloader(max_downloads=getattr(config, 'max_concurrent_downloads', 4))
+
+# Updates are processed in order within each chat and in parallel across chats
+chat_scheduler = ChatScheduler(max_concurrency=getattr(config, 'max_concurrent_updates', 8))
+
+# Items of albums are collected to be saved as one note
+albums = AlbumCollector(window=getattr(config, 'album_window', 1.0))
+
+# Answers are sent without exceeding Telegram limits
+outbox = Outbox(global_rate=getattr(config, 'outbox_global_rate', 30),
+                chat_rate=getattr(config, 'outbox_chat_rate', 1),
+                group_rate=getattr(config, 'outbox_group_rate', 20 / 60))
+
+# Note blocks are appended to note files in batches by background tasks
+note_writer = NoteWriter(flush_interval=getattr(config, 'note_flush_interval', 1.0),
+                         flush_size=getattr(config, 'note_flush_size', 64 * 1024),
+                         fsync=getattr(config, 'note_fsync', 'never'),
+                         on_write=note_written,
+                         max_retries=getattr(config, 'note_write_retries', 3),
+                         spool_path=getattr(config, 'note_spool_path', 'unsaved_notes.md'))
+
 # TODO: assign values of config variables to local variables using the form `my_chat_id = getattr(config, "my_chat_id", 123456789)` and change all references to these variables accordingly
 
 class CommonMiddleware(BaseMiddleware):
 
     async def __call__(self, handler, event: types.Update, data: dict):
+        message = event.message
+        if not message:
+            return await self.process(handler, event, data)
+
+        # Логирование сообщения
+        log_message(message)
+
+        album = None
+        if is_album_item(message):
+            # Items are joined to the album before scheduling, so they never wait in the chat queue behind the first item
+            album = albums.add(message)
+            if album is None:
+                # The message is handled together with the first item of its album
+                return
+
+        # Updates of one chat are processed in the order received, updates of different chats at the same time
+        received = time.perf_counter()
+        try:
+            return await chat_scheduler.run(message.chat.id, lambda: self.process(handler, event, data, album, received))
+        finally:
+            update_seconds.observe(time.perf_counter() - received)
+
+    async def process(self, handler, event: types.Update, data: dict, album: Album | None = None, received: float = 0):
         message = event.message
         if message:
-            await bot.send_chat_action(chat_id=message.from_user.id, action='typing')
-            # Логирование сообщения
-            log_message(message)
+            if album:
+                album = await albums.collect(album)
+                data["album"] = album
+            if received:
+                update_wait_seconds.observe(time.perf_counter() - received)
 
             # Проверка идентификатора чата
-            if message.chat.id not in allowed_chats:
+            if message.chat.id not in settings.current().allowed_chats:
                 await message.reply(f"I'm not configured to accept messages in this chat.\nIf you think I should do so, please add <code>{message.chat.id}</code> to <b>allowed_chats</b> in config.")
                 return
 
             notes_folder = get_notes_folder(message.chat.id)
             note = note_from_message(message, notes_folder)
             data["note"] = note
+
+            # Typing is shown only if the message takes noticeable time to process
+            typing = asyncio.get_running_loop().call_later(getattr(config, 'typing_delay', 1.0), post_chat_action, message)
         try:
             result = await handler(event, data)
-            if 'delete_messages' in dir(config) and config.delete_messages:
-                await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
+            if settings.current().delete_messages:
+                if album:
+                    await bot.delete_messages(chat_id=message.chat.id, message_ids=[m.message_id for m in album])
+                else:
+                    await bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
             else:
-                await bot.set_message_reaction(chat_id=message.from_user.id, message_id=message.message_id, reaction=[{'type':'emoji', 'emoji':'👌'}])
+                # One reaction to the last message of a burst of messages
+                outbox.post_later(message.chat.id, 'reaction',
+                                  lambda: bot.set_message_reaction(chat_id=message.chat.id, message_id=message.message_id, reaction=[{'type':'emoji', 'emoji':'👌'}]),
+                                  getattr(config, 'reaction_window', 2.0))
             return result
         except Exception as e:
             log_basic(f'Exception: {e}')
             print(f'Exception: {e}')
-            await bot.set_message_reaction(chat_id=message.from_user.id, message_id=message.message_id, reaction=[{'type':'emoji', 'emoji':'🤷‍♂'}])
+            outbox.post(message.chat.id,
+                        lambda: bot.set_message_reaction(chat_id=message.chat.id, message_id=message.message_id, reaction=[{'type':'emoji', 'emoji':'🤷‍♂'}]),
+                        PRIORITY_COSMETIC)
             await answer_message(message, f'🤷‍♂️ {e}')
             return
+        finally:
+            if message:
+                typing.cancel()
 
-bot = Bot(token = config.token, parse_mode=ParseMode.HTML)
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Measures the time spent in every message handler and profiles sampled and slow ones"""
+
+    async def __call__(self, handler, event: Message, data: dict):
+        name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        try:
+            if profiler.enabled():
+                return await profiler.run(lambda: handler(event, data), f'message-{event.content_type.value}', name)
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(1, name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+
+if getattr(config, 'telegram_api_server', ''):
+    # Local Bot API server or a fake Telegram endpoint for testing
+    bot = Bot(token = config.token, parse_mode=ParseMode.HTML,
+              session=AiohttpSession(api=TelegramAPIServer.from_base(config.telegram_api_server)))
+else:
+    bot = Bot(token = config.token, parse_mode=ParseMode.HTML)
 # router = Router()
 dp = Dispatcher()
 dp.update.middleware(CommonMiddleware())  # Регистрация middleware
+dp.message.middleware(HandlerMetricsMiddleware())
 
 
 class Note:
@@ -91,33 +224,55 @@ if 'log_level' in dir(config) and config.log_level >= 1:
     log = logging.getLogger()
 
 if config.ocr:
-    import pytesseract
-    from PIL import Image
+    from ocr import OcrEngine
+
+    ocr_engine = OcrEngine(workers=getattr(config, 'ocr_workers', 2),
+                           max_size=getattr(config, 'ocr_max_image_size', 4000),
+                           max_dpi=getattr(config, 'ocr_max_dpi', 300),
+                           timeout=getattr(config, 'ocr_timeout', 60))
 
     if config.ocr_languages:
         ocr_languages = config.ocr_languages
     else:
         ocr_languages = 'eng'
+    # Recognized text depends on image preprocessing as well, so it is a part of the cache key
+    ocr_model = f'tesseract-{ocr_engine.max_size}px-{ocr_engine.max_dpi}dpi'
     print(f'Prepared for OCR in {ocr_languages}')
 
 if config.recognize_voice:
-    import torch
-    import whisper
-    import gc
+    from stt_jobs import SttQueue
 
     whisper_device = getattr(config, 'whisper_device', 'cpu')
 
-    if whisper_device == 'cpu':
-        torch.cuda.is_available = lambda : False
-
-    model = whisper.load_model(config.whisper_model)
+    # Whisper model is loaded in worker processes on the first voice message and unloaded when not used
+    stt_queue = SttQueue(config.whisper_model, whisper_device,
+                         workers=getattr(config, 'whisper_workers', 1),
+                         max_queue=getattr(config, 'stt_queue_size', 10),
+                         idle_timeout=getattr(config, 'whisper_idle_timeout', 600),
+                         backend=getattr(config, 'stt_backend', 'whisper'),
+                         compute_type=getattr(config, 'whisper_compute_type', 'int8'),
+                         cpu_threads=getattr(config, 'whisper_cpu_threads', 0),
+                         segment_length=getattr(config, 'stt_segment_length', 30),
+                         min_silence=getattr(config, 'stt_min_silence', 0.5),
+                         on_recognized=speech_recognized)
+
+    stt_model = f"{getattr(config, 'stt_backend', 'whisper')}-{config.whisper_model}"
+    print(f'Prepared for speech-to-text recognition on {whisper_device}')
 
-    if whisper_device == 'cuda' and torch.cuda.is_available():
-        model = model.to('cuda')
-    else:
-        model = model.to('cpu')
+# Recognized text is kept by file_unique_id, so a voice message or an image forwarded again is not recognized again
+recognition_cache = None
+if getattr(config, 'recognition_cache', True):
+    recognition_cache = RecognitionCache(max_age=getattr(config, 'recognition_cache_max_age', 180 * 24 * 3600),
+                                         max_size=getattr(config, 'recognition_cache_max_size', 50 * 1024 * 1024))
 
-    print(f'Prepared for speech-to-text recognition on {whisper_device}')
+metrics.gauge('tg2obsidian_chat_queue_depth', 'Updates of the chat waiting or being processed', chat_scheduler.depths, ('chat',))
+metrics.gauge('tg2obsidian_outbox_depth', 'Bot API calls waiting to be sent', outbox.depth)
+metrics.gauge('tg2obsidian_note_writer_depth', 'Note blocks waiting to be written', note_writer.depth)
+metrics.gauge('tg2obsidian_albums_pending', 'Albums being collected', albums.pending)
+if config.recognize_voice:
+    metrics.gauge('tg2obsidian_stt_queue_depth', 'Audio files waiting for speech recognition', stt_queue.depth)
+    metrics.gauge('tg2obsidian_stt_model_loaded', '1 if the speech recognition model is loaded', lambda: int(stt_queue.loaded()))
+metrics.gauge('tg2obsidian_uptime_seconds', 'Time since the bot was started', metrics.uptime)
 
 def should_add_timestamp(message: Message) -> bool:
     """
@@ -139,7 +294,7 @@ def should_add_timestamp(message: Message) -> bool:
     time_diff = (current_time - last_message_times[chat_id]).total_seconds()
     last_message_times[chat_id] = current_time
     
-    return time_diff >= config.message_timestamp_interval
+    return time_diff >= settings.current().message_timestamp_interval
 
 # Handlers
 @dp.message(Command("start"))
@@ -181,6 +336,12 @@ Your current notes folder: <code>{current_notes_folder}</code>
     result = set_notes_folder(message.chat.id, relative_folder_path)
     await answer_message(message, result)
 
+@dp.message(Command("stats"))
+async def command_stats(message: types.Message, note: Note):
+    """Show how the bot is doing since it was started"""
+    log_basic(f'Received stats command for chat {message.chat.id} from @{message.from_user.username}')
+    await answer_message(message, format_stats())
+
 @dp.message(Command("help"))
 async def command_help(message: types.Message, note: Note):
     reply_text = '''
@@ -189,6 +350,7 @@ async def command_help(message: types.Message, note: Note):
 /set_folder - set or reset custom relative folder for saving notes
     usage: <code>/set_folder path/to/folder</code>
     <code>/set_folder</code> without path resets custom folder to the default
+/stats - show processing time, downloads, recognition and queues of the Bot
 text, media, picture message of other kinds of messages - to be passed into Obsidian inbox. Text may be added according to text recognition settings in config
 '''
     await answer_message(message, reply_text)
@@ -200,25 +362,24 @@ async def handle_voice_message(message: Message, note: Note):
         log_basic(f'Voice recognition is turned OFF')
         return
 
-    path = os.path.dirname(__file__)
-    voice_file = await bot.get_file(message.voice.file_id)
-    voice_file_ext = message.voice.mime_type.split('/')[-1]
-    file_name=f"{message.voice.file_id}.{voice_file_ext}"
-    await handle_file(file=voice_file, file_name=file_name, path=path)
-
-    file_full_path = os.path.join(path, file_name)
+    async def download() -> str:
+        path = os.path.dirname(__file__)
+        voice_file = await outbox.call(lambda: bot.get_file(message.voice.file_id))
+        voice_file_ext = message.voice.mime_type.split('/')[-1]
+        file_name=f"{message.voice.file_id}.{voice_file_ext}"
+        await handle_file(file=voice_file, file_name=file_name, path=path)
+        return os.path.join(path, file_name)
 
     try:
-        note_stt = await stt(file_full_path)
+        note_stt = await recognize_speech(message.voice.file_unique_id, download)
         note.text = note_stt
     except Exception as e:
         await answer_message(message, f'🤷‍♂️ {e}')
     try:
-        await answer_message(message, note_stt)
+        await answer_message(message, note_stt, wait=False)
     except Exception as e:
         await answer_message(message, f'🤷‍♂️ {e}')
     save_message(note)
-    os.remove(file_full_path)
 
 @dp.message(F.audio)
 async def handle_audio(message: Message, note: Note):
@@ -227,21 +388,20 @@ async def handle_audio(message: Message, note: Note):
         log_basic(f'Voice recognition is turned OFF')
         return
 
+    async def download() -> str:
+        audio = await outbox.call(lambda: message.audio.get_file())
+        path = os.path.dirname(__file__)
+        await handle_file(file=audio, file_name=f"{message.audio.file_name}", path=path)
+        return os.path.join(path, message.audio.file_name)
+
     try:
-        audio = await message.audio.get_file()
+        note_stt = await recognize_speech(message.audio.file_unique_id, download)
     except Exception as e:
         log_basic(f'Exception: {e}')
         await answer_message(message, f'🤷‍♂️ {e}')
         return
-
-    path = os.path.dirname(__file__)
-
-    await handle_file(file=audio, file_name=f"{message.audio.file_name}", path=path)
-    file_full_path = os.path.join(path, message.audio.file_name)
-
-    note_stt = await stt(file_full_path)
     try:
-        await answer_message(message, note_stt)
+        await answer_message(message, note_stt, wait=False)
     except Exception as e:
         await answer_message(message, f'🤷‍♂️ {e}')
     # Add label, if any, and a file name
@@ -252,18 +412,51 @@ async def handle_audio(message: Message, note: Note):
 
     note.text = f'{file_details}\n{note_stt}'
     save_message(note)
-    os.remove(file_full_path)
+
+@dp.message(F.func(lambda message: is_album_item(message)))
+async def handle_album(message: Message, note: Note, album: list[Message]):
+    log_basic(f'Received album of {len(album)} items from @{message.from_user.username}')
+
+    # All items are downloaded at the same time. Items that could not be downloaded are reported, the rest are saved
+    results = await asyncio.gather(*[store_album_item(m) for m in album], return_exceptions=True)
+    stored = [(m, result) for m, result in zip(album, results) if not isinstance(result, BaseException)]
+    errors = [(number, result) for number, result in enumerate(results, 1) if isinstance(result, BaseException)]
+    if not stored:
+        raise errors[0][1]
+    for number, e in errors:
+        log_basic(f'Item {number} of the album was not saved: {e}')
+        await answer_message(message, html_decoration.quote(f'🤷‍♂️ Item {number} of the album was not saved: {e}'))
+    embeds = [embed for _, embed in stored]
+    print(f'Got album: {", ".join(name for name, _ in embeds)}')
+
+    captions = [await embed_formatting_caption(m) for m in album if m.caption]
+    note.text = get_forward_info(message) + ''.join(f'{embed}\n' for _, embed in embeds) + '\n'.join(captions)
+
+    # Распознавание текста с изображений альбома
+    if config.ocr:
+        images = [(name, m.photo[-1].file_unique_id if m.photo else m.document.file_unique_id)
+                  for m, (name, _) in stored
+                  if m.photo or (m.document and (m.document.mime_type or '').split('/')[0] == 'image')]
+        recognized = await asyncio.gather(*[recognize_text_from_image(os.path.join(config.photo_path, name), ocr_languages, file_unique_id)
+                                            for name, file_unique_id in images])
+        recognized_text = '\n'.join(text for text in recognized if text)
+        if recognized_text:
+            note.text += f'\n{recognized_text}'
+            try:
+                await answer_message(message, html_decoration.quote(recognized_text))
+            except Exception as e:
+                await answer_message(message, f'🤷‍♂️ {e}')
+        else:
+            log_basic("No text recognized in the album.")
+
+    save_message(note)
 
 @dp.message(F.photo)
 async def handle_photo(message: Message, note: Note):
     log_basic(f'Received photo from @{message.from_user.username}')
 
-    photo = message.photo[-1]
-    file_name = unique_indexed_filename(create_media_file_name(message, 'pic', 'jpg'), config.photo_path) # or photo.file_id + '.jpg'
+    file_name = await store_photo(message)
     print(f'Got photo: {file_name}')
-    photo_file = await bot.get_file(photo.file_id)
-
-    await handle_file(file=photo_file, file_name=file_name, path=config.photo_path)
 
     forward_info = get_forward_info(message)
     photo_and_caption = f'{forward_info}![[{file_name}]]\n{await embed_formatting_caption(message)}'
@@ -271,7 +464,7 @@ async def handle_photo(message: Message, note: Note):
     # Распознавание текста с фото
     if config.ocr:
         image_path = os.path.join(config.photo_path, file_name)
-        recognized_text = await recognize_text_from_image(image_path, ocr_languages)
+        recognized_text = await recognize_text_from_image(image_path, ocr_languages, message.photo[-1].file_unique_id)
         if recognized_text:
             recognized_text_safe = html_decoration.quote(recognized_text)
             photo_and_caption += f'\n{recognized_text}'
@@ -287,26 +480,36 @@ async def handle_photo(message: Message, note: Note):
 
 @dp.message(F.document)
 async def handle_document(message: Message, note: Note):
-    file_name = unique_filename(message.document.file_name, config.photo_path)
-    log_basic(f'Received document {file_name} ({message.document.mime_type}) from @{message.from_user.username}')
-    print(f'Got document: {file_name} ({message.document.mime_type})')
+    log_basic(f'Received document {message.document.file_name} ({message.document.mime_type}) from @{message.from_user.username}')
+    is_audio = config.recognize_voice and message.document.mime_type.split('/')[0] == 'audio'
 
     try:
-        file = await bot.get_file(message.document.file_id)
-        await handle_file(file=file, file_name=file_name, path=config.photo_path)
+        if is_audio:
+            # Audio is removed after recognition, so it is not put into the attachment index.
+            # It is downloaded only if the transcript is not cached, then the note shows the unique name it got
+            file_name = message.document.file_name
+        else:
+            file_name = await store_document(message)
     except Exception as e:
         log_basic(f'Exception: {e}')
         await answer_message(message, f'🤷‍♂️ {e}')
         return
+    print(f'Got document: {file_name} ({message.document.mime_type})')
 
-    if config.recognize_voice and message.document.mime_type.split('/')[0] == 'audio':
+    if is_audio:
     # if mime type = "audio/*", recognize it like ContentType.AUDIO
-        await bot.send_chat_action(chat_id=message.from_user.id, action=types.ChatActions.TYPING)
+        post_chat_action(message)
+
+        async def download() -> str:
+            nonlocal file_name
+            audio_file_name = await unique_filename(message.document.file_name, config.photo_path)
+            await download_reserved(message.document.file_id, audio_file_name, config.photo_path)
+            file_name = audio_file_name
+            return os.path.join(config.photo_path, audio_file_name)
 
-        file_full_path = os.path.join(config.photo_path, file_name)
-        note_stt = await stt(file_full_path)
+        note_stt = await recognize_speech(message.document.file_unique_id, download)
         try:
-            await answer_message(message, note_stt)
+            await answer_message(message, note_stt, wait=False)
         except Exception as e:
             await answer_message(message, f'🤷‍♂️ {e}')
         # Add label, if any, and a file name
@@ -316,10 +519,9 @@ async def handle_document(message: Message, note: Note):
             file_details = bold(file_name)
 
         note.text = f'{file_details}\n{note_stt}'
-        os.remove(file_full_path)
     elif message.document.mime_type.split('/')[0] == 'image' and config.ocr:
         image_path = os.path.join(config.photo_path, file_name)
-        recognized_text = await recognize_text_from_image(image_path, ocr_languages)
+        recognized_text = await recognize_text_from_image(image_path, ocr_languages, message.document.file_unique_id)
         if recognized_text:
             recognized_text_safe = html_decoration.quote(recognized_text)
             note.text += f'\n{recognized_text}'
@@ -353,46 +555,35 @@ async def handle_location(message: Message, note: Note):
 
 @dp.message(F.animation)
 async def handle_animation(message: Message, note: Note):
-    if message.document.file_name:
-        file_name = unique_filename(message.document.file_name, config.photo_path)
-    else:
-        file_name = unique_indexed_filename(create_media_file_name(message, 'animation', 'mp4'), config.photo_path)
+    async def make_file_name():
+        if message.document.file_name:
+            return await unique_filename(message.document.file_name, config.photo_path)
+        return await unique_indexed_filename(create_media_file_name(message, 'animation', 'mp4'), config.photo_path)
+
+    file_name = await store_attachment(message.document.file_id, message.document.file_unique_id, make_file_name)
     log_basic(f'Received animation {file_name} from @{message.from_user.username}')
     print(f'Got animation: {file_name}')
 
-    file = await bot.get_file(message.document.file_id)
-    await handle_file(file=file, file_name=file_name, path=config.photo_path)
-
     forward_info = get_forward_info(message)
     note.text = f'{forward_info}![[{file_name}]]\n{await embed_formatting_caption(message)}'
     save_message(note)
 
 @dp.message(F.video)
 async def handle_video(message: Message, note: Note):
-    if message.video.file_name:
-        file_name = unique_filename(message.video.file_name, config.photo_path)
-    else:
-        file_name = unique_indexed_filename(create_media_file_name(message, 'video', 'mp4'), config.photo_path)
+    file_name = await store_video(message)
     log_basic(f'Received video {file_name} from @{message.from_user.username}')
     print(f'Got video: {file_name}')
 
-    file = await bot.get_file(message.video.file_id)
-
-    await handle_file(file=file, file_name=file_name, path=config.photo_path)
-
     note.text = f'{get_forward_info(message)}![[{file_name}]]\n{await embed_formatting_caption(message)}'
     save_message(note)
 
 @dp.message(F.video_note)
 async def handle_video_note(message: Message, note: Note):
-    file_name = unique_indexed_filename(create_media_file_name(message.video_note, 'video_note', 'mp4'), config.photo_path)
+    file_name = await store_attachment(message.video_note.file_id, message.video_note.file_unique_id,
+                                       lambda: unique_indexed_filename(create_media_file_name(message.video_note, 'video_note', 'mp4'), config.photo_path))
     log_basic(f'Received video note from @{message.from_user.username}')
     print(f'Got video note: {file_name}')
 
-    file = await bot.get_file(message.video_note.file_id)
-
-    await handle_file(file=file, file_name=file_name, path=config.photo_path)
-
     note.text = f'{get_forward_info(message)}![[{file_name}]]\n{await embed_formatting_caption(message)}'
     save_message(note)
 
@@ -417,6 +608,7 @@ async def process_message(message: types.Message, note: Note):
 async def handle_file(file: File, file_name: str, path: str):
     """
     Downloads a file from Telegram and saves it to the specified path.
+    The file is streamed to disk in chunks using the shared HTTP session.
 
     Parameters:
     file (File): The file object containing the file path on Telegram's server.
@@ -424,17 +616,105 @@ async def handle_file(file: File, file_name: str, path: str):
     path (str): The directory path where the file will be saved.
 
     Returns:
-    bool: True if the file was successfully downloaded and saved, False otherwise.
+    str: SHA-256 hex digest of the saved file, or empty string if the download failed.
     """
     Path(f"{path}").mkdir(parents=True, exist_ok=True)
     destination = f"{path}/{file_name}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"https://api.telegram.org/file/bot{config.token}/{file.file_path}") as resp:
-            if resp.status == 200:
-                f = await aiofiles.open(destination, mode='wb')
-                await f.write(await resp.read())
-                await f.close()
-    return (resp.status == 200)
+    started = time.perf_counter()
+    sha256 = await downloader.download(bot.session.api.file_url(config.token, file.file_path), destination)
+    if sha256:
+        download_seconds.observe(time.perf_counter() - started)
+        download_bytes.inc(file.file_size or os.path.getsize(destination))
+    return sha256
+
+async def download_reserved(file_id: str, file_name: str, path: str) -> str:
+    """
+    Downloads a Telegram file into the file reserved by unique_filename or unique_indexed_filename.
+    If the download fails, the empty file reserving the name is removed and the error is raised.
+
+    Returns:
+    str: SHA-256 hex digest of the saved file.
+    """
+    try:
+        file = await outbox.call(lambda: bot.get_file(file_id))
+        sha256 = await handle_file(file=file, file_name=file_name, path=path)
+        if not sha256:
+            raise RuntimeError(f'Could not download {file_name} from Telegram')
+    except BaseException:
+        try:
+            os.remove(os.path.join(path, file_name))
+        except FileNotFoundError:
+            pass
+        raise
+    return sha256
+
+async def store_attachment(file_id: str, file_unique_id: str, make_file_name) -> str:
+    """
+    Saves a Telegram file into photo_path unless the same file is already stored there.
+    Known files are looked up by file_unique_id before the download and by SHA-256 after it.
+
+    Parameters:
+    file_id (str): Telegram file_id used to download the file.
+    file_unique_id (str): Telegram file_unique_id which is the same for the file in any message.
+    make_file_name (callable): Coroutine function reserving the name for a new file. Called only if the file has to be downloaded.
+
+    Returns:
+    str: The name of the file in photo_path to embed into the note.
+    """
+    known_file_name = find_attachment(file_unique_id)
+    if known_file_name and os.path.exists(os.path.join(config.photo_path, known_file_name)):
+        log_basic(f'File {file_unique_id} is already stored as {known_file_name}, download skipped')
+        return known_file_name
+
+    file_name = await make_file_name()
+    sha256 = await download_reserved(file_id, file_name, config.photo_path)
+
+    for same_file_name in find_attachments_by_hash(sha256):
+        if same_file_name != file_name and os.path.exists(os.path.join(config.photo_path, same_file_name)):
+            log_basic(f'File {file_name} is the same as stored {same_file_name}, duplicate removed')
+            os.remove(os.path.join(config.photo_path, file_name))
+            file_name = same_file_name
+            break
+
+    save_attachment(file_unique_id, sha256, file_name)
+    return file_name
+
+async def store_photo(message: Message) -> str:
+    photo = message.photo[-1]
+    return await store_attachment(photo.file_id, photo.file_unique_id,
+                                  lambda: unique_indexed_filename(create_media_file_name(message, 'pic', 'jpg'), config.photo_path)) # or photo.file_id + '.jpg'
+
+async def store_video(message: Message) -> str:
+    async def make_file_name():
+        if message.video.file_name:
+            return await unique_filename(message.video.file_name, config.photo_path)
+        return await unique_indexed_filename(create_media_file_name(message, 'video', 'mp4'), config.photo_path)
+
+    return await store_attachment(message.video.file_id, message.video.file_unique_id, make_file_name)
+
+async def store_document(message: Message) -> str:
+    return await store_attachment(message.document.file_id, message.document.file_unique_id,
+                                  lambda: unique_filename(message.document.file_name, config.photo_path))
+
+async def store_album_item(message: Message) -> tuple[str, str]:
+    """Save the file of the album item. Returns the file name and the link to put into the note"""
+    if message.photo:
+        file_name = await store_photo(message)
+        return file_name, f'![[{file_name}]]'
+    if message.video:
+        file_name = await store_video(message)
+        return file_name, f'![[{file_name}]]'
+    file_name = await store_document(message)
+    return file_name, f'[[{file_name}]]'
+
+def is_album_item(message: Message) -> bool:
+    """Check if the message is an item of an album saved as one note"""
+    if not message.media_group_id:
+        return False
+    if message.photo or message.video:
+        return True
+    # Audio is recognized item by item, as separate messages
+    return bool(message.document) and not (config.recognize_voice and (message.document.mime_type or '').split('/')[0] == 'audio')
 
 def get_forward_info(m: Message) -> str:
     # If the message is forwarded, extract forward info and make up forward header
@@ -495,16 +775,17 @@ def log_message(message):
 
 
 def get_note_file_name_parts(curr_date):
-    filename_part1 = config.note_prefix if 'note_prefix' in dir(config) else ''
-    filename_part3 = config.note_postfix if 'note_postfix' in dir(config) else ''
-    filename_part2 = curr_date if 'note_date' in dir(config) and config.note_date is True else ''
+    cfg = settings.current()
+    filename_part1 = cfg.note_prefix
+    filename_part3 = cfg.note_postfix
+    filename_part2 = curr_date if cfg.note_date else ''
     return [filename_part1, filename_part2, filename_part3]
 
 def get_note_name(curr_date, notes_folder) -> str:
     date_parts = curr_date.split('-')
     year, month, day = date_parts[0], date_parts[1], date_parts[2] # type: ignore
 
-    note_name = config.note_name_template.format(year=year, month=month, day=day)
+    note_name = settings.current().note_name_template.format(year=year, month=month, day=day)
     return os.path.join(notes_folder, f'{note_name}.md')
 
 
@@ -513,7 +794,7 @@ def create_media_file_name(message: Message, suffix = 'media', ext = 'jpg') -> s
     date_parts = curr_date.split('-')
     year, month, day = date_parts[0], date_parts[1], date_parts[2]
 
-    note_name = config.note_name_template.format(year=year, month=month, day=day)
+    note_name = settings.current().note_name_template.format(year=year, month=month, day=day)
 
     # Remove unnecessary characters from the file name
     note_name = re.sub(r'[^\w\-_\.]', '_', note_name)
@@ -526,16 +807,14 @@ def get_curr_date() -> str:
 
 
 def one_line_note() -> bool:
-    one_line_note = False if 'one_line_note' not in dir(config) or config.one_line_note == False else True
-    return one_line_note
+    return settings.current().one_line_note
 
 
 def format_messages() -> bool:
-    format_messages = True if 'format_messages' not in dir(config) or config.format_messages else False
-    return format_messages
+    return settings.current().format_messages
 
 def create_link_info() -> bool:
-    return False if 'create_link_info' not in dir(config) else config.create_link_info
+    return settings.current().create_link_info
 
 
 def save_message(note: Note) -> None:
@@ -543,35 +822,45 @@ def save_message(note: Note) -> None:
     curr_time = note.time
     
     relative_folder_path = note.notes_folder
-    folder_path = os.path.join(config.inbox_path, relative_folder_path)
+    folder_path = os.path.join(settings.current().inbox_path, relative_folder_path)
     
+    add_timestamp = one_line_note() or not hasattr(note, 'message') or should_add_timestamp(note.message)
+    note_text = format_note_block(note.text, curr_date, curr_time, add_timestamp)
+
+    on_error = None
+    if note.message is not None:
+        on_error = lambda e: report_note_error(note.message, e)
+    note_writer.append(get_note_name(curr_date, folder_path), note_text, on_error)
+
+def report_note_error(message: Message, e: Exception) -> None:
+    """Tell the sender that the message was not written to the note. Notes are written after the message is handled"""
+    outbox.post(message.chat.id,
+                lambda: bot.set_message_reaction(chat_id=message.chat.id, message_id=message.message_id, reaction=[{'type':'emoji', 'emoji':'🤷‍♂'}]),
+                PRIORITY_COSMETIC)
+    outbox.post(message.chat.id, lambda: message.answer(html_decoration.quote(f'🤷‍♂️ The message was not saved to the note: {e}')))
+
+def format_note_block(text: str, curr_date: str, curr_time: str, add_timestamp: bool = True) -> str:
+    """Make up the text appended to the note for a single message"""
     if one_line_note():
         # Replace all line breaks with spaces and make simple time stamp
-        note_body = note.text.replace('\n', ' ')
-        note_text = check_if_task(check_if_negative(f'[[{curr_date}]] - {note_body}\n'))
-    else:
-        # Keep line breaks and add a header with a time stamp
-        note_body = check_if_task(check_if_negative(note.text))
-        if hasattr(note, 'message') and not should_add_timestamp(note.message):
-            note_text = f'{note_body}\n\n'
-        else:
-            note_text = f'#### [[{curr_date}]] {curr_time}\n{note_body}\n\n'
+        note_body = text.replace('\n', ' ')
+        return settings.current().keyword_rules.apply(f'[[{curr_date}]] - {note_body}\n')
 
-    with open(get_note_name(curr_date, folder_path), 'a', encoding='UTF-8') as f:
-        f.write(note_text)
+    # Keep line breaks and add a header with a time stamp
+    note_body = settings.current().keyword_rules.apply(text)
+    if not add_timestamp:
+        return f'{note_body}\n\n'
+    return f'#### [[{curr_date}]] {curr_time}\n{note_body}\n\n'
 
 def check_if_task(note_body) -> str:
-    is_task = False
-    for keyword in config.task_keywords:
-        if keyword.lower() in note_body.lower(): is_task = True
+    is_task, _ = settings.current().keyword_rules.match(note_body)
     if is_task: note_body = '- [ ] ' + note_body
     return note_body
 
 def check_if_negative(note_body) -> str:
-    is_negative = False
-    for keyword in config.negative_keywords:
-        if keyword.lower() in note_body.lower(): is_negative = True
-    if is_negative: note_body += f'\n{config.negative_tag}'
+    cfg = settings.current()
+    _, tags = cfg.keyword_rules.match(note_body)
+    if cfg.negative_tag in tags: note_body += f'\n{cfg.negative_tag}'
     return note_body
 
 # returns index of a first non ws character in a string
@@ -611,66 +900,118 @@ def parse_entities(text: bytes,
     entities: list[MessageEntity],
     offset: int,
     end: int) -> str:
-    formatted_note = ''
+    """
+    Converts text with Telegram entities to Markdown.
 
-    for entity_index, entity in enumerate(entities):
-        entity_start = entity.offset * 2
-        if entity_start < offset:
-            continue
-        if entity_start > offset:
-            formatted_note += from_u16(text[offset:entity_start])
-        offset = entity_end = entity_start + entity.length * 2
-
-        format = entity.type
-        if format == 'pre':
-            pre_content = from_u16(text[entity_start:entity_end])
-            content_parts = partition_string(pre_content)
-            formatted_note += '```'
-            if (len(content_parts[0]) == 0 and
-                content_parts[1].find('\n') == -1):
-                formatted_note += '\n'
-            formatted_note += pre_content
-            if content_parts[2].find('\n') == -1:
-                formatted_note += '\n'
-            formatted_note += '```'
-            if (len(text) - entity_end < 2 or
-               from_u16(text[entity_end:entity_end+2])[0] != '\n'):
-                formatted_note += '\n'
-            continue
-        # parse nested entities for example: "**bold _italic_**"
-        sub_entities = [e for e in entities[entity_index + 1:] if e.offset * 2 < entity_end]
-        parsed_entity = parse_entities(text, sub_entities, entity_start, entity_end)
-        content_parts = partition_string(parsed_entity)
-        content = content_parts[1]
-        if format in formats:
-            format_code = formats[format]
-            formatted_note += content_parts[0]
-            i = 0
-            while i < len(content):
-                index = content.find('\n\n', i) # inline formatting across paragraphs, need to split
-                if index == -1:
-                    formatted_note += format_code[0] + content[i:] + format_code[1] # type: ignore
-                    break
-                formatted_note += format_code[0] + content[i:index] + format_code[1] # type: ignore
-                i = index
-                while i < len(content) and content[i] == '\n': # type: ignore
-                    formatted_note += '\n'
-                    i += 1
-            formatted_note += content_parts[2]
-            continue
-        if format == 'mention':
-            formatted_note += f'{content_parts[0]}[{content}](https://t.me/{content[1:]}){content_parts[2]}' # type: ignore
-            continue
-        if format == 'text_link':
-            formatted_note += f'{content_parts[0]}[{content}]({entity.url}){content_parts[2]}'
+    Entities are sorted by offset once and walked with an explicit stack instead of recursion:
+    each stack frame collects the pieces of one entity's content, nested entities push new frames.
+    The UTF-16 text is decoded once, entity offsets are mapped to indexes in the decoded string.
+    """
+    decoded = text.decode('utf-16-le')
+    text_len = len(text)
+    if len(decoded) * 2 == text_len:
+        # No surrogate pairs, UTF-16 offsets match string indexes
+        index = None
+    else:
+        index = [-1] * (text_len // 2 + 1)
+        u16_offset = 0
+        for i, char in enumerate(decoded):
+            index[u16_offset] = i
+            u16_offset += 2 if ord(char) > 0xFFFF else 1
+        index[u16_offset] = len(decoded)
+
+    def substring(start: int, stop: int) -> str:
+        # Same as from_u16(text[start:stop]) for offsets in bytes
+        start = min(start, text_len)
+        stop = min(stop, text_len)
+        if start >= stop:
+            return ''
+        if index is None:
+            return decoded[start // 2:stop // 2]
+        str_start = index[start // 2]
+        str_stop = index[stop // 2]
+        if str_start == -1 or str_stop == -1:
+            raise ValueError(f'Entity boundary {start // 2 if str_start == -1 else stop // 2} splits a surrogate pair')
+        return decoded[str_start:str_stop]
+
+    entities = sorted(entities, key=lambda e: e.offset)
+    entities_count = len(entities)
+
+    # Frame: [next entity index, bound for entity offsets, offset, end, output pieces, entity being parsed]
+    stack = [[0, None, offset, end, [], None]]
+    while True:
+        frame = stack[-1]
+        entity_index, bound, offset, end, pieces, _ = frame
+        if entity_index < entities_count and (bound is None or entities[entity_index].offset * 2 < bound):
+            entity = entities[entity_index]
+            frame[0] = entity_index + 1
+            entity_start = entity.offset * 2
+            if entity_start < offset:
+                continue
+            if entity_start > offset:
+                pieces.append(substring(offset, entity_start))
+            frame[2] = entity_end = entity_start + entity.length * 2
+
+            if entity.type == 'pre':
+                pre_content = substring(entity_start, entity_end)
+                content_parts = partition_string(pre_content)
+                pieces.append('```')
+                if (len(content_parts[0]) == 0 and
+                    content_parts[1].find('\n') == -1):
+                    pieces.append('\n')
+                pieces.append(pre_content)
+                if content_parts[2].find('\n') == -1:
+                    pieces.append('\n')
+                pieces.append('```')
+                if (text_len - entity_end < 2 or
+                   substring(entity_end, entity_end + 2)[0] != '\n'):
+                    pieces.append('\n')
+                continue
+            # parse nested entities for example: "**bold _italic_**"
+            nested_bound = entity_end if bound is None else min(bound, entity_end)
+            stack.append([entity_index + 1, nested_bound, entity_start, entity_end, [], entity])
             continue
-        # Not processed (makes no sense): url, hashtag, cashtag, bot_command, email, phone_number
-        # Not processed (hard to visualize using Markdown): spoiler, text_mention, custom_emoji
-        formatted_note += parsed_entity
 
-    if offset < end:
-        formatted_note += from_u16(text[offset:end])
-    return formatted_note
+        if offset < end:
+            pieces.append(substring(offset, end))
+        parsed_entity = ''.join(pieces)
+        stack.pop()
+        if not stack:
+            return parsed_entity
+        parent = stack[-1]
+        # Entities handled by the nested frame start before the parent's offset and would be skipped anyway
+        parent[0] = entity_index
+        parent[4].append(format_entity(frame[5], parsed_entity))
+
+
+def format_entity(entity: MessageEntity, parsed_entity: str) -> str:
+    """Wrap the parsed content of the entity in Markdown markup"""
+    format = entity.type
+    content_parts = partition_string(parsed_entity)
+    content = content_parts[1]
+    if format in formats:
+        format_code = formats[format]
+        pieces = [content_parts[0]]
+        i = 0
+        while i < len(content):
+            index = content.find('\n\n', i) # inline formatting across paragraphs, need to split
+            if index == -1:
+                pieces.append(format_code[0] + content[i:] + format_code[1])
+                break
+            pieces.append(format_code[0] + content[i:index] + format_code[1])
+            i = index
+            while i < len(content) and content[i] == '\n':
+                pieces.append('\n')
+                i += 1
+        pieces.append(content_parts[2])
+        return ''.join(pieces)
+    if format == 'mention':
+        return f'{content_parts[0]}[{content}](https://t.me/{content[1:]}){content_parts[2]}'
+    if format == 'text_link':
+        return f'{content_parts[0]}[{content}]({entity.url}){content_parts[2]}'
+    # Not processed (makes no sense): url, hashtag, cashtag, bot_command, email, phone_number
+    # Not processed (hard to visualize using Markdown): spoiler, text_mention, custom_emoji
+    return parsed_entity
 
 def is_single_url(message: Message) -> bool:
     # assuming there is atleast one entity
@@ -687,55 +1028,44 @@ def is_single_url(message: Message) -> bool:
             return False
     return True
 
-async def download(url, session: aiohttp.ClientSession) -> str:
-    async with session.get(url) as response:
-        return await response.text()
-
-def get_open_graph_props(page: str) -> dict:
-    props = {}
-    soup = BeautifulSoup(page, 'lxml')
-    meta = soup.find_all("meta", property=lambda x: x is not None and x.startswith("og:"))
-    for m in meta:
-        props[m['property'][3:].lstrip()] = m['content']
-    if not 'description' in props:
-        m = soup.find("meta", attrs={"name": "description"})
-        if m:
-            props['description'] = m['content']
-    if not 'title' in props:
-        props['title'] = soup.title.string
-
-    return props
+# Parsed link previews are cached, so the same page is not downloaded again for every message
+link_previews = LinkPreviewCache(ttl=getattr(config, 'link_preview_ttl', 7 * 24 * 3600),
+                                 negative_ttl=getattr(config, 'link_preview_negative_ttl', 3600),
+                                 memory_size=getattr(config, 'link_preview_memory_size', 256),
+                                 max_fetches=getattr(config, 'link_preview_max_fetches', 8),
+                                 per_host=getattr(config, 'link_preview_per_host', 2),
+                                 connect_timeout=getattr(config, 'link_preview_connect_timeout', 5),
+                                 read_timeout=getattr(config, 'link_preview_read_timeout', 10),
+                                 max_bytes=getattr(config, 'link_preview_max_bytes', 512 * 1024))
 
 async def get_url_info_formatting(url: str) -> str:
-    async with aiohttp.ClientSession() as session:
-        page = await download(url, session)
-        og_props = get_open_graph_props(page)
-        if 'image' in og_props or 'description' in og_props:
-            sep = ''
-            image = ''
-            callout_type = "[!link-info-ni]"
-            if 'image' in og_props:
-                image += "!["
-                if 'image:alt' in og_props:
-                   image += og_props['image:alt'].replace("\n", " ")
-                image += f"]({og_props['image']})"
-                if 'image:width' in og_props and int(og_props['image:width']) < 600:
-                    callout_type = "[!link-info]"
-                else:
-                    callout_type = "[!link-preview]"
-                sep = "\n>"
-            formatted_note = f'\n> {callout_type}'
-            if 'site_name' in og_props:
-                formatted_note += f" [{og_props['site_name']}]({url})"
-            if 'title' in og_props:
-                formatted_note += "\n> # " + og_props['title']
-            if 'description' in og_props:
-                formatted_note += "\n> "
-                formatted_note += "\n> ".join(og_props['description'].split('\n')) + sep
-            if 'image' in og_props:
-                formatted_note += f"\n> [{image}]({url})"
-            return formatted_note + "\n"
-        return ''
+    og_props = await link_previews.get(url)
+    if 'image' in og_props or 'description' in og_props:
+        sep = ''
+        image = ''
+        callout_type = "[!link-info-ni]"
+        if 'image' in og_props:
+            image += "!["
+            if 'image:alt' in og_props:
+               image += og_props['image:alt'].replace("\n", " ")
+            image += f"]({og_props['image']})"
+            if 'image:width' in og_props and int(og_props['image:width']) < 600:
+                callout_type = "[!link-info]"
+            else:
+                callout_type = "[!link-preview]"
+            sep = "\n>"
+        formatted_note = f'\n> {callout_type}'
+        if 'site_name' in og_props:
+            formatted_note += f" [{og_props['site_name']}]({url})"
+        if 'title' in og_props:
+            formatted_note += "\n> # " + og_props['title']
+        if 'description' in og_props:
+            formatted_note += "\n> "
+            formatted_note += "\n> ".join(og_props['description'].split('\n')) + sep
+        if 'image' in og_props:
+            formatted_note += f"\n> [{image}]({url})"
+        return formatted_note + "\n"
+    return ''
 
 async def embed_formatting(message: Message) -> str:
     # If the message contains any formatting (including inline links), add corresponding Markdown markup
@@ -788,36 +1118,63 @@ async def embed_formatting_caption(message: Message) -> str:
         formatted_note = note
     return formatted_note
 
-async def recognize_text_from_image(image_path: str, ocr_languages: str) -> str:
+async def recognize_text_from_image(image_path: str, ocr_languages: str, file_unique_id: str = '') -> str:
     """
-    Recognizes text from an image using OCR.
+    Recognizes text from an image using OCR in a worker process.
 
     Parameters:
     image_path (str): The path to the image file.
     ocr_languages (str): The languages to use for OCR.
+    file_unique_id (str): Telegram file_unique_id of the image. Text of known images is taken from the cache.
 
     Returns:
     str: The recognized text.
     """
-    try:
-        img = Image.open(image_path)
-        recognized_text = pytesseract.image_to_string(img, lang=ocr_languages)
-        return recognized_text.strip()
-    except Exception as e:
-        log_basic(f'Error during text recognition from {image_path} in {ocr_languages}: {e}')
-        return ''
+    async def recognize() -> str:
+        started = time.perf_counter()
+        text = await ocr_engine.recognize(image_path, ocr_languages)
+        ocr_seconds.observe(time.perf_counter() - started)
+        return text
 
-async def stt(audio_file_path) -> str:
-    log_basic(f'Starting audio recognition on {whisper_device}')
+    if recognition_cache is None or not file_unique_id:
+        return await recognize()
+    # Recognition errors give empty text, so empty results are not cached
+    return await recognition_cache.get_or_create(file_unique_id, ENGINE_OCR, ocr_model, ocr_languages,
+                                                 recognize, keep_empty=False)
+
+async def recognize_speech(file_unique_id: str, download) -> str:
+    """
+    Returns the transcript of the audio file. The file is downloaded and recognized only if its transcript is not cached.
+
+    Parameters:
+    file_unique_id (str): Telegram file_unique_id of the audio.
+    download (callable): Coroutine function downloading the file and returning its path. The file is removed after recognition.
+
+    Returns:
+    str: The recognized text.
+    """
+    async def recognize() -> str:
+        audio_file_path = await download()
+        try:
+            return await stt(audio_file_path)
+        finally:
+            os.remove(audio_file_path)
+
+    if recognition_cache is None:
+        return await recognize()
+    return await recognition_cache.get_or_create(file_unique_id, ENGINE_STT, stt_model, stt_queue.language, recognize)
 
-    result = model.transcribe(audio_file_path, verbose=False, language='ru')
+async def stt(audio_file_path) -> str:
+    """
+    Recognizes speech in the audio file using Whisper worker processes.
+    The coroutine waits for the job while other updates keep being processed.
+    """
+    log_basic(f'Queued audio recognition of {audio_file_path} on {whisper_device} ({stt_queue.depth()} jobs waiting)')
 
-    if whisper_device == 'cuda' and torch.cuda.is_available():
-        # Clear GPU memory
-        torch.cuda.empty_cache()
+    segments = await stt_queue.submit(audio_file_path)
 
-    if hasattr(result['segments'], '__iter__'): # type: ignore
-        rawtext = ' '.join([segment['text'].strip() for segment in result['segments']]) # type: ignore
+    if segments:
+        rawtext = ' '.join([segment['text'].strip() for segment in segments])
         rawtext = re.sub(" +", " ", rawtext)
 
         alltext = re.sub(r"([\.\!\?]) ", "\\1\n", rawtext)
@@ -831,47 +1188,50 @@ async def stt(audio_file_path) -> str:
 
     return alltext
 
-def unique_filename(file: str, path: str) -> str:
-    """Change file name if file already exists"""
-    # create target folder if not exist
-    if not os.path.exists(path):
-        os.makedirs(path)
-    # check if file exists
-    if not os.path.exists(os.path.join(path, file)):
-        return file
-    # get file name and extension
-    filename, filext = os.path.splitext(file)
-    # get full file path without extension only
-    filexx = os.path.join(path, filename)
-    # create incrementing variable
-    i = 1
-    # determine incremented filename
-    while os.path.exists(f'{filexx}_{str(i)}{filext}'):
-        # update the incrementing variable
-        i += 1
-    return f'{filename}_{str(i)}{filext}'
-
-
-def unique_indexed_filename(file: str, path: str) -> str:
-    """Add minimal unique numeric index to file name to make up non existing file name"""
-    # create target folder if not exist
-    if not os.path.exists(path):
-        os.makedirs(path)
-    # get file name and extension
-    filename, filext = os.path.splitext(file)
-    # get full file path without extension only
-    filexx = os.path.join(path, filename)
-    # create incrementing variable
-    i = 1
-    # determine incremented filename
-    while os.path.exists(f'{filexx}{i:02}{filext}'):
-        # update the incrementing variable
-        i += 1
-    unique_indexed_filename = f'{filename}{i:02}{filext}'
-    # create file to avoid reusing the same file name more than once
-    with open(os.path.join(path, unique_indexed_filename), 'w') as f:
-        f.write('')
-    return unique_indexed_filename
+def format_stats() -> str:
+    """Summary of metrics for /stats command"""
+    def latency(histogram, *labels) -> str:
+        return f'p50 {histogram.quantile(0.5, *labels):.2f} s, p95 {histogram.quantile(0.95, *labels):.2f} s'
+
+    uptime = int(metrics.uptime())
+    lines = [f'<b>Uptime:</b> {uptime // 86400} d {uptime % 86400 // 3600:02}:{uptime % 3600 // 60:02}:{uptime % 60:02}',
+             f'<b>Updates:</b> {update_seconds.count()}, {latency(update_seconds)}, waiting {latency(update_wait_seconds)}']
+
+    handlers = sorted(handler_seconds.values, key=lambda labels: -handler_seconds.count(*labels))
+    for labels in handlers:
+        errors = int(handler_errors.value(*labels))
+        lines.append(f'    {labels[0]}: {handler_seconds.count(*labels)}, {latency(handler_seconds, *labels)}'
+                     + (f', {errors} errors' if errors else ''))
+
+    download_time = download_seconds.sum()
+    lines.append(f'<b>Downloads:</b> {download_seconds.count()} files, {download_bytes.value() / 2**20:.1f} MB'
+                 + (f', {download_bytes.value() / 2**20 / download_time:.1f} MB/s' if download_time else ''))
+    if config.recognize_voice:
+        audio_length = stt_audio_seconds.value()
+        lines.append(f'<b>Speech recognition:</b> {stt_seconds.count()} files, {audio_length / 60:.1f} min of audio'
+                     + (f', real-time factor {stt_seconds.sum() / audio_length:.2f}' if audio_length else '')
+                     + f', model {"loaded" if stt_queue.loaded() else "not loaded"}')
+    if config.ocr:
+        lines.append(f'<b>OCR:</b> {ocr_seconds.count()} images, {latency(ocr_seconds)}')
+    lines.append(f'<b>Notes:</b> {note_write_seconds.count()} writes, {latency(note_write_seconds)}, '
+                 f'delay {latency(note_delay_seconds)}')
+
+    queues = [f'chats {sum(chat_scheduler.depths().values())}', f'outbox {outbox.depth()}',
+              f'notes {note_writer.depth()}', f'albums {albums.pending()}']
+    if config.recognize_voice:
+        queues.append(f'speech {stt_queue.depth()}')
+    lines.append(f'<b>Queues:</b> {", ".join(queues)}')
+    return '\n'.join(lines)
+
+async def unique_filename(file: str, path: str) -> str:
+    """Change file name if file already exists. The name is reserved by creating an empty file"""
+    return await file_names.allocate(file, path)
+
+
+async def unique_indexed_filename(file: str, path: str) -> str:
+    """Add the next unused numeric index to file name to make up non existing file name"""
+    # file is created to avoid reusing the same file name more than once
+    return await file_names.allocate(file, path, indexed=True)
 
 
 async def get_contact_data(message: Message) -> str:
@@ -918,55 +1278,82 @@ async def get_telegram_username(user_id: int) -> str:
     return result
 
 
-async def answer_message(message: Message, answer_text: str):
+def post_chat_action(message: Message, action: str = 'typing') -> None:
+    """Show the action (typing by default) in the chat of the message, unless more important calls have to be made"""
+    outbox.post(message.chat.id, lambda: bot.send_chat_action(chat_id=message.chat.id, action=action), PRIORITY_COSMETIC)
+
+
+async def answer_message(message: Message, answer_text: str, wait: bool = True):
+    """
+    Send the text to the chat of the message, split into several messages if it is too long.
+    Messages are queued in the outbox. If wait is False, the function returns without waiting for delivery.
+    A part that cannot be sent is replaced with a message about the error, the other parts are still sent.
+    """
     # Telegram limit is 4096 characters in a message
     msg_len_limit = 4000
     if len(answer_text) <= msg_len_limit:
-        await message.answer(answer_text)
+        chunks = [answer_text]
     else:
         chunks = text_to_chunks(answer_text, msg_len_limit)
-        for chunk in chunks:
-            try:
-                await message.answer(chunk)
-            except Exception as e:
-                await message.answer(f'🤷‍♂️ {e}')
-            time.sleep(0.03)
+
+    def report_error(future: asyncio.Future):
+        if future.cancelled() or future.exception() is None:
+            return
+        e = future.exception()
+        log_basic(f'Error sending a message to chat {message.chat.id}: {e}')
+        outbox.post(message.chat.id, lambda: message.answer(html_decoration.quote(f'🤷‍♂️ {e}')))
+
+    futures = []
+    for chunk in chunks:
+        future = outbox.send(message.chat.id, lambda chunk=chunk: message.answer(chunk))
+        future.add_done_callback(report_error)
+        futures.append(future)
+    if wait:
+        await asyncio.gather(*futures, return_exceptions=True)
 
 
 def text_to_chunks(text, max_len):
     """ Accepts a string text and splits it into parts of up to max_len characters. Returns a list of parts"""
-    sentences = [piece.strip() + '.' for piece in text.split('.')]
     texts = []
-    chunk = ''
-
-    for sentence in sentences:
-        if len(sentence) > max_len or len(chunk + ' ' + sentence) > max_len:
+    # The chunk is kept as a list of pieces with its length counted separately,
+    # so adding a piece does not copy the whole chunk
+    chunk = []
+    chunk_len = 0
+
+    for piece in text.split('.'):
+        sentence = piece.strip() + '.'
+        if len(sentence) > max_len or chunk_len + 1 + len(sentence) > max_len:
             # This sentence does not fit into the current chunk
-            if len(chunk) > 0:
+            if chunk_len > 0:
                 # If there is something in the chunk, save it
-                texts.append(chunk.strip(' '))
-                chunk = ''
+                texts.append(''.join(chunk).strip(' '))
+                chunk = []
+                chunk_len = 0
             # Chunk is empty, start filling it
             if len(sentence) > max_len:
                 # If the current sentence is too long, put only as much as fits into the chunk
                 words = sentence.split(' ')
                 for word in words:
-                    if len(chunk + ' ' + word) < max_len:
+                    if chunk_len + 1 + len(word) < max_len:
                         # This word fits into the current chunk, add it
-                        chunk += ' ' + word
+                        chunk += (' ', word)
+                        chunk_len += 1 + len(word)
                     else:
                         # This word does not fit into the current chunk
-                        texts.append(chunk.strip(' '))
-                        chunk = word
+                        texts.append(''.join(chunk).strip(' '))
+                        chunk = [word]
+                        chunk_len = len(word)
             else:
                 # Chunk was empty, so just add the sentence to it
-                chunk = sentence
+                chunk = [sentence]
+                chunk_len = len(sentence)
 
         else:
             # This sentence fits into the current chunk, add it
-            chunk += ' ' + sentence
+            chunk += (' ', sentence)
+            chunk_len += 1 + len(sentence)
     # Save the last chunk, if it is not empty
-    if len(chunk) > 0: texts.append(chunk.strip(' '))
+    if chunk_len > 0: texts.append(''.join(chunk).strip(' '))
     return texts
 
 def get_location_note(message: Message) -> str:
@@ -1007,17 +1394,116 @@ def note_from_message(message: Message, notes_folder: str) -> Note:
     Returns:
         Note: Note object with message metadata
     """
-    local_tz = timezone(config.time_zone)
-    message_date = message.date.astimezone(local_tz)
+    message_date = message.date.astimezone(settings.current().time_zone)
     msg_date = message_date.strftime('%Y-%m-%d')
     msg_time = message_date.strftime('%H:%M:%S')
     return Note(date=msg_date, time=msg_time, notes_folder=notes_folder, message=message)
 
 
+def update_mode() -> str:
+    return getattr(config, 'update_mode', 'polling')
+
+
+async def on_startup() -> None:
+    global config_watcher
+    if update_mode() == 'webhook':
+        certificate = getattr(config, 'webhook_ssl_cert', '')
+        await bot.set_webhook(url=config.webhook_url,
+                              certificate=types.FSInputFile(certificate) if certificate else None,
+                              secret_token=getattr(config, 'webhook_secret', '') or None,
+                              allowed_updates=dp.resolve_used_update_types())
+        log_basic(f'Webhook set to {config.webhook_url}')
+    else:
+        # Updates cannot be polled while a webhook is set
+        await bot.delete_webhook()
+    link_previews.purge()
+    metrics_port = getattr(config, 'metrics_port', 0)
+    if metrics_port:
+        try:
+            await metrics.serve(getattr(config, 'metrics_host', '127.0.0.1'), metrics_port)
+        except OSError as e:
+            log_basic(f'Cannot serve metrics on port {metrics_port}: {e}')
+    if recognition_cache is not None:
+        # Results of other models and languages would never be used again
+        if config.ocr:
+            recognition_cache.invalidate(ENGINE_OCR, ocr_model, ocr_languages)
+        if config.recognize_voice:
+            recognition_cache.invalidate(ENGINE_STT, stt_model, stt_queue.language)
+        recognition_cache.purge()
+    reload_interval = getattr(config, 'config_reload_interval', 5)
+    if reload_interval:
+        config_watcher = asyncio.create_task(settings.watch(reload_interval))
+    if config.recognize_voice:
+        stt_queue.start()
+
+
+async def on_shutdown() -> None:
+    if config_watcher is not None:
+        config_watcher.cancel()
+    # Let updates already received be saved
+    await chat_scheduler.close()
+    if config.recognize_voice:
+        await stt_queue.stop()
+    if config.ocr:
+        ocr_engine.stop()
+    await downloader.close()
+    await link_previews.close()
+    await note_writer.close()
+    # Replies and errors of the last notes are sent after everything producing them is closed
+    await outbox.close()
+    await metrics.close()
+    close_connection()
+
+
+async def start_webhook() -> None:
+    """
+    Receive updates from Telegram by webhook instead of polling.
+    Telegram gets the response at once, the update is processed in background.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True,
+                         secret_token=getattr(config, 'webhook_secret', '') or None,
+                         ).register(app, path=getattr(config, 'webhook_path', '/tg2obsidian'))
+    # Startup and shutdown of the dispatcher are bound to the web application
+    setup_application(app, dp, bot=bot)
+
+    ssl_context = None
+    certificate = getattr(config, 'webhook_ssl_cert', '')
+    if certificate:
+        # TLS is terminated by the bot itself rather than by a reverse proxy
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(certificate, config.webhook_ssl_key)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    host = getattr(config, 'webhook_host', '127.0.0.1')
+    port = getattr(config, 'webhook_port', 8080)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop.set)
+        except NotImplementedError:
+            # Not supported on Windows, Ctrl+C still stops the bot
+            pass
+    try:
+        await web.TCPSite(runner, host=host, port=port, ssl_context=ssl_context).start()
+        log_basic(f'Listening for webhook updates on {host}:{port}')
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
 async def main() -> None:
     # Initialize Bot instance with a default parse mode which will be passed to all API calls
     # And the run events dispatching
-    await dp.start_polling(bot)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if update_mode() == 'webhook':
+        await start_webhook()
+    else:
+        await dp.start_polling(bot)
 
 if __name__ == '__main__':
     print('Bot started')